@@ -0,0 +1,7 @@
+import os
+
+# turg.config reads these when turg.models is imported
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('CONFIG_FILE', os.path.join(ROOT, 'config.yml'))
+os.environ.setdefault('SERVICE_ACCOUNT', 'test')
+os.environ.setdefault('JWT_CERTS_URL', 'http://localhost/certs')
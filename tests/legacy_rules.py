@@ -0,0 +1,99 @@
+from turg import rules
+
+# Placement rules as turg.models checked them over neighbour records before
+# turg.rules evaluated them vectorised. The reference for test_rules.py and
+# tools/rules_benchmark.py.
+
+
+def get_neighbours(world, voxel, range):
+    return world.neighbours(voxel.x, voxel.y, voxel.z, range)
+
+
+def space_occupied(voxel, neighbours):
+    curr_voxel = [n for n in neighbours if n['x'] == voxel.x
+                  and n['y'] == voxel.y and n['z'] == voxel.z]
+    return curr_voxel[0] if curr_voxel else {}
+
+
+def valid_location(voxel, adjacent):
+    return [n for n in adjacent if
+            n['y'] == voxel.y and n['z'] == voxel.z or
+            n['y'] == voxel.y and n['x'] == voxel.x or
+            n['z'] == voxel.z and n['x'] == voxel.x] \
+           or voxel.z == 0
+
+
+def immediate_neighbours(voxel, neighbours):
+    return [n for n in neighbours if
+            n.get('x') <= voxel.x + 1 and n.get('x') >= voxel.x - 1
+            and n.get('y') <= voxel.y + 1 and n.get('y') >= voxel.y - 1
+            and n.get('z') <= voxel.z + 1 and n.get('z') >= voxel.z - 1]
+
+
+def too_close(voxel, adjacent):
+    return [n for n in adjacent if n['owner'] != voxel.owner]
+
+
+def too_close_to_flag(voxel, neighbours):
+    flags = [n for n in neighbours if n.get('name')]
+    for flag in flags:
+        if all([abs(coord) <= 4 for coord in [(voxel.x - flag.get('x')),
+                                              (voxel.y - flag.get('y')),
+                                              (voxel.z - flag.get('z'))]]):
+            return flag
+    return None
+
+
+def too_far_from_flag(voxel, neighbours, flag):
+    return all([n.get('owner') != voxel.owner for n in neighbours])
+
+
+def legacy_check(world, voxel):
+    neighbours = get_neighbours(world, voxel, rules.NEIGHBOURS_RANGE)
+
+    occupied = space_occupied(voxel, neighbours)
+    flag = occupied if occupied.get('name') else None
+
+    if flag and flag.get('owner') != voxel.owner:
+        if too_far_from_flag(voxel, neighbours, flag):
+            return rules.TOO_FAR, flag
+        return rules.CAPTURE, flag
+
+    if occupied:
+        return rules.OCCUPIED, occupied
+
+    near_neighbours = immediate_neighbours(voxel, neighbours)
+
+    conflict = too_close(voxel, near_neighbours)
+    if conflict:
+        return rules.TOO_CLOSE, conflict
+
+    if not valid_location(voxel, near_neighbours):
+        return rules.UNSUPPORTED, None
+
+    near_flag = too_close_to_flag(voxel, neighbours)
+    if near_flag:
+        return rules.NEAR_FLAG, near_flag
+
+    return rules.OK, None
+
+
+def coords(record):
+    return record['x'], record['y'], record['z'], record['owner']
+
+
+def same_outcome(world, voxel, legacy, vectorised):
+    (legacy_rule, legacy_conflict), (rule, conflict) = legacy, vectorised
+
+    if legacy_rule != rule:
+        return False
+
+    if rule == rules.TOO_CLOSE:
+        return sorted(map(coords, legacy_conflict)) == sorted(map(coords, conflict))
+
+    if rule == rules.NEAR_FLAG:
+        # With several flags in reach either one may be reported
+        return conflict['name'] and all(abs(conflict[axis] - getattr(voxel, axis)) <=
+                                        rules.FLAG_RANGE for axis in 'xyz')
+
+    return legacy_conflict == conflict
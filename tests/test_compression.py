@@ -0,0 +1,95 @@
+import asyncio
+import zlib
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from aiohttp.http_websocket import WebSocketWriter, WSMsgType  # noqa: E402
+
+from turg.compression import FLUSH_TRAILER, CompressionPolicy, PolicyWebSocketResponse  # noqa: E402
+
+MESSAGES = [
+    'short',
+    '{"x": 1, "y": 2, "z": 3, "owner": "#ff00ff"}, ' * 40,
+    b'\x00\x01\x02',
+    'é' * 40,  # 40 characters, 80 bytes
+    bytes(range(256)) * 8,
+    '{"x": 1, "y": 2, "z": 3, "owner": "#ff00ff"}, ' * 40,
+    'ok',
+]
+
+
+class Transport(object):
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data.extend(data)
+
+
+class Stream(object):
+    def __init__(self):
+        self.transport = Transport()
+
+    async def drain(self):
+        pass
+
+
+def connect(policy, wbits):
+    # The response as prepare() leaves it once the client accepted deflate with wbits
+    stream = Stream()
+    ws = PolicyWebSocketResponse(policy)
+    ws._writer = WebSocketWriter(stream, compress=wbits)
+    ws._writer._compressobj = policy.compressor(wbits)
+    ws.deflate = wbits
+
+    return ws, stream.transport
+
+
+def frames(data):
+    # (compressed, opcode, payload) of unmasked, unfragmented frames
+    offset = 0
+
+    while offset < len(data):
+        first, length = data[offset], data[offset + 1] & 0x7f
+        offset += 2
+        if length == 126:
+            length = int.from_bytes(data[offset:offset + 2], 'big')
+            offset += 2
+        elif length == 127:
+            length = int.from_bytes(data[offset:offset + 8], 'big')
+            offset += 8
+
+        yield bool(first & 0x40), first & 0x0f, bytes(data[offset:offset + length])
+        offset += length
+
+
+@pytest.mark.parametrize('wbits', [15, 10])
+def test_mixed_frames_round_trip(wbits):
+    policy = CompressionPolicy(threshold=64)
+    ws, transport = connect(policy, wbits)
+    loop = asyncio.new_event_loop()
+
+    for message in MESSAGES:
+        send = ws.send_str if isinstance(message, str) else ws.send_bytes
+        loop.run_until_complete(asyncio.ensure_future(send(message), loop=loop))
+    loop.close()
+
+    # One inflater for the whole connection, as a client keeps the context across frames
+    inflater = zlib.decompressobj(-wbits)
+    received = list(frames(transport.data))
+    assert len(received) == len(MESSAGES)
+
+    for message, (compressed, opcode, payload) in zip(MESSAGES, received):
+        encoded = message.encode('utf-8') if isinstance(message, str) else message
+        assert compressed == (len(encoded) >= policy.threshold)
+        assert opcode == (WSMsgType.TEXT if isinstance(message, str) else WSMsgType.BINARY)
+
+        if compressed:
+            payload = inflater.decompress(payload + FLUSH_TRAILER)
+        assert payload == encoded
+
+    assert policy.stats['compressed'] == 4
+    assert policy.stats['uncompressed'] == 3
+    assert policy.report()['bytes_saved'] > 0
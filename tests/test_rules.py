@@ -0,0 +1,85 @@
+import random
+
+import pytest
+
+from tests.legacy_rules import legacy_check, same_outcome
+from turg import rules
+from turg.models import Voxel
+from turg.world import World
+
+OWNERS = [f'#{i + 1:06x}' for i in range(6)]
+SIZE = 40
+HEIGHT = 8
+
+
+@pytest.fixture
+def world():
+    random.seed(7)
+    world = World()
+
+    for x in range(SIZE):
+        for y in range(SIZE):
+            owner = OWNERS[(x // 8 + y // 8) % len(OWNERS)]
+            for z in range(random.randint(0, HEIGHT)):
+                world.set(x, y, z, owner)
+
+    for i in range(15):
+        x, y = random.randrange(SIZE), random.randrange(SIZE)
+        world.set(x, y, random.randint(0, HEIGHT), '#ff00ff', f'Flag {i}')
+
+    return world
+
+
+def placements(count):
+    return [Voxel(random.randrange(-2, SIZE + 2), random.randrange(-2, SIZE + 2),
+                  random.randint(0, HEIGHT + 2), random.choice(OWNERS))
+            for _ in range(count)]
+
+
+def assert_same(world, voxels):
+    outcomes = set()
+
+    for voxel in voxels:
+        legacy = legacy_check(world, voxel)
+        vectorised = rules.check(world, voxel.x, voxel.y, voxel.z, voxel.owner)
+        assert same_outcome(world, voxel, legacy, vectorised), (voxel, legacy, vectorised)
+        outcomes.add(vectorised[0])
+
+    return outcomes
+
+
+def test_check_matches_neighbour_records(world):
+    outcomes = assert_same(world, placements(2000))
+
+    # The random world must exercise the interesting rules, not only the easy ones
+    assert {rules.OK, rules.OCCUPIED, rules.TOO_CLOSE, rules.UNSUPPORTED} <= outcomes
+
+
+def test_check_matches_after_changes(world):
+    # Chunk grids are built by the first checks and must follow later changes
+    assert_same(world, placements(300))
+
+    for voxel in placements(600):
+        rule, _ = rules.check(world, voxel.x, voxel.y, voxel.z, voxel.owner)
+        if rule in (rules.OK, rules.CAPTURE):
+            world.set(voxel.x, voxel.y, voxel.z, voxel.owner)
+
+    for voxel in placements(200):
+        world.remove(voxel.x, voxel.y, voxel.z)
+
+    assert_same(world, placements(1000))
+
+
+def test_flag_rules():
+    world = World()
+    world.set(10, 10, 0, '#000001')
+    world.set(11, 10, 0, '#000001')
+    world.set(12, 10, 0, '#ff00ff', 'Flag')
+
+    for voxel in (Voxel(12, 10, 0, '#000001'), Voxel(12, 10, 0, '#000002'),
+                  Voxel(13, 10, 0, '#000001'), Voxel(20, 20, 0, '#000002')):
+        assert same_outcome(world, voxel, legacy_check(world, voxel),
+                            rules.check(world, voxel.x, voxel.y, voxel.z, voxel.owner))
+
+    assert rules.check(world, 12, 10, 0, '#000001')[0] == rules.CAPTURE
+    assert rules.check(world, 12, 10, 0, '#000002')[0] == rules.TOO_FAR
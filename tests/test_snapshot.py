@@ -0,0 +1,107 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from turg.snapshot import Snapshot, SnapshotWriter, dump, load_latest, snapshots
+from turg.world import World
+
+OWNERS = ['#ff0000', '#00ff00', '#0000ff', '#ff00ff']
+START = datetime(2017, 10, 18, 12, 0, 0)
+
+
+@pytest.fixture
+def world():
+    # Chunks of 8 share the owners, a few flags and one chunk emptied again
+    world = World(8)
+
+    for x in range(0, 40, 2):
+        for y in range(0, 40, 3):
+            world.set(x, y, x % 7, OWNERS[(x + y) % len(OWNERS)], None,
+                      START + timedelta(seconds=x * y))
+    world.set(5, 5, 9, '#ff00ff', 'Flag ø', START)
+    world.set(33, 1, 12, '#ff00ff', 'Flag 2', START)
+    world.set(100, 100, 0, OWNERS[1])
+    world.remove(100, 100, 0)
+
+    return world
+
+
+def voxels(world):
+    # Every voxel with all it keeps, by position
+    found = []
+
+    for x in range(120):
+        for y in range(120):
+            for z in range(13):
+                voxel = world.get(x, y, z)
+                if voxel is not None:
+                    found.append(voxel)
+
+    return found
+
+
+def save(directory, world, taken=1508328000.5):
+    path = os.path.join(str(directory), 'world.snap')
+    with open(path, 'wb') as snapshot:
+        snapshot.write(dump(world, taken))
+
+    return path
+
+
+def test_empty_world(tmpdir):
+    with Snapshot(save(tmpdir, World(8))) as snapshot:
+        assert len(snapshot) == 0
+        assert snapshot.palette == []
+        loaded = snapshot.world()
+
+    assert loaded.count == 0
+    assert loaded.version == 0
+
+
+def test_round_trip(tmpdir, world):
+    with Snapshot(save(tmpdir, world)) as snapshot:
+        assert snapshot.taken == 1508328000.5
+        assert snapshot.chunk_size == 8
+        assert snapshot.palette == world.palette
+        assert len(snapshot) == world.count
+        loaded = snapshot.world()
+
+    assert loaded.version == world.version
+    assert loaded.count == world.count
+    assert voxels(loaded) == voxels(world)
+    assert loaded.rect(0, 40, 0, 40) == world.rect(0, 40, 0, 40)
+
+    # A loaded world keeps working as one
+    assert loaded.set(1, 1, 0, '#123456') == world.version + 1
+    assert loaded.get(1, 1, 0)['owner'] == '#123456'
+
+
+def test_arrays_in_place(tmpdir, world):
+    with Snapshot(save(tmpdir, world)) as snapshot:
+        for key in snapshot.index:
+            updated, versions, offsets, owners = snapshot.arrays(key)
+            chunk = world.columns[key[:2]][key[2]]
+            assert list(versions) == list(chunk.versions)
+            assert list(owners) == list(chunk.owners)
+            assert snapshot.names(key) == chunk.names
+            del updated, versions, offsets, owners
+
+
+def test_writer_keeps_newest(tmpdir, world):
+    writer = SnapshotWriter(world, str(tmpdir), keep=2)
+    loop = asyncio.new_event_loop()
+
+    for i in range(4):
+        world.set(50 + i, 50, 0, OWNERS[0])
+        loop.run_until_complete(writer.write())
+        # Files are named by the millisecond they were taken
+        loop.run_until_complete(asyncio.sleep(0.002))
+    loop.close()
+
+    assert len(snapshots(str(tmpdir))) == 2
+    loaded, taken = load_latest(str(tmpdir), 8)
+    assert loaded.version == world.version
+    assert voxels(loaded) == voxels(world)
+    assert load_latest(str(tmpdir), 16) == (None, None)
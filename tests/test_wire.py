@@ -0,0 +1,78 @@
+import pytest
+
+from turg import wire
+from turg.models import paginate
+from turg.world import World
+
+OWNERS = ['#ff0000', '#00ff00', '#0000ff', '#ff00ff']
+
+
+@pytest.fixture
+def world():
+    # Chunks of 8 share the owners, some flags, one voxel beyond u16 coordinates
+    world = World(8)
+
+    for x in range(30):
+        for y in range(0, 30, 3):
+            world.set(x, y, (x * y) % 5, OWNERS[(x + y) % len(OWNERS)])
+    world.set(4, 4, 9, '#ff00ff', 'Flag ø')
+    world.set(20, 21, 9, '#ff00ff', 'Flag 2')
+    world.set(70000, 3, 1, OWNERS[0])
+
+    return world
+
+
+def round_trip(voxels, meta):
+    decoded, decoded_meta = wire.decode_range(wire.encode_range(voxels, meta))
+
+    assert decoded == voxels
+    for key, value in meta.items():
+        assert decoded_meta[key] == value
+
+    return decoded_meta
+
+
+def test_empty_area():
+    meta = round_trip([], {'id': 'empty', 'version': 0, 'since': None, 'epoch': 1})
+    assert 'seq' not in meta
+
+
+def test_single_frame(world):
+    voxels = world.rect(0, 70000, 0, 30)
+    assert len({voxel['owner'] for voxel in voxels}) == len(OWNERS)
+    assert sum('name' in voxel for voxel in voxels) == 2
+
+    round_trip(voxels, {'id': {'request': 1}, 'version': world.version, 'since': 3,
+                        'epoch': world.epoch})
+
+
+@pytest.mark.parametrize('page_size', [1, 7, 64, 10000])
+def test_pages(world, page_size):
+    columns = world.rect_columns(0, 30, 0, 30)
+    received = []
+
+    for seq, (page, end) in enumerate(paginate(columns, page_size)):
+        meta = round_trip(page, {'id': 'ü' * 10, 'version': world.version, 'since': None,
+                                 'epoch': world.epoch, 'seq': seq, 'end': end})
+        assert meta['type'] == 'range'
+        received.extend(page)
+
+    assert meta['end']
+    assert received == [voxel for column in world.rect_columns(0, 30, 0, 30)
+                        for voxel in column]
+
+
+def test_id_length():
+    # As the id is written in the header, non-ascii characters are escaped
+    assert wire.id_length('a' * 254) == wire.MAX_ID_LENGTH
+    assert wire.id_length('ø' * 50) > wire.MAX_ID_LENGTH
+    header = wire.encode_header(wire.RANGE, {'id': {'a': 1}})
+    assert wire.id_length({'a': 1}) == len(header) - wire.HEADER.size
+
+
+def test_not_a_range_frame():
+    frame = bytearray(wire.encode_range([], {'id': 1}))
+    frame[4] = wire.FORMAT_VERSION - 1
+
+    with pytest.raises(ValueError):
+        wire.decode_range(bytes(frame))
@@ -0,0 +1,459 @@
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from aiohttp import ClientSession, WSMsgType, web
+from google.auth import crypt, jwt
+from pymongo import MongoClient
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from turg.wire import decode_range  # noqa: E402
+
+# Load generator for the websocket API. Starts turg.main:app under gunicorn
+# against a local mongod, with JWT certificates, the google token endpoint and
+# firebase user colours served by a stub in this process, then drives a swarm
+# of simulated players sending range/update requests and writes the results as JSON.
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--clients", help="simulated players", default=50, type=int)
+parser.add_argument("--duration", help="measured seconds", default=30, type=float)
+parser.add_argument("--warmup", help="seconds before measuring starts", default=5, type=float)
+parser.add_argument("--rate", help="requests per second per player", default=2, type=float)
+parser.add_argument("--update-ratio", help="share of update requests", default=0.3, type=float)
+parser.add_argument("--range", help="range request radius", default=25, type=int)
+parser.add_argument("--spread", help="distance between player home spots", default=12, type=int)
+parser.add_argument("--origin", help="x and y of the first home spot", default=100, type=int)
+parser.add_argument("--protocol", help="json or binary range replies", default='json', type=str)
+parser.add_argument("--stream", help="ask for range replies in pages", action='store_true')
+parser.add_argument("--workers", help="gunicorn workers", default=1, type=int)
+parser.add_argument("--port", help="server port, a free one by default", default=0, type=int)
+parser.add_argument("--turg-db", help="benchmark mongodb uri, db name starting with turg_bench",
+                    default='mongodb://localhost:27017/turg_bench', type=str)
+parser.add_argument("--keep-db", help="do not drop the benchmark db", action='store_true')
+parser.add_argument("--output", help="results file", default='loadtest.json', type=str)
+args = parser.parse_args()
+
+AUDIENCE = 'theurbngame'
+KEY_ID = 'loadtest'
+BENCH_DB_PREFIX = 'turg_bench'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def uid(index):
+    return f'loadtest-{index}'
+
+
+def user_color(index):
+    return f'#{index + 1:06x}'
+
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, int(p * len(values)))]
+
+    return {
+        'count': len(values),
+        'p50': rank(0.50),
+        'p95': rank(0.95),
+        'p99': rank(0.99),
+        'max': values[-1],
+    }
+
+
+def make_keys(directory):
+    key, cert = os.path.join(directory, 'key.pem'), os.path.join(directory, 'cert.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                    '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=loadtest'],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    with open(key) as key_file, open(cert) as cert_file:
+        return key_file.read(), cert_file.read()
+
+
+def make_token(signer, index):
+    now = int(time.time())
+    payload = {
+        'user_id': uid(index),
+        'name': f'Player {index}',
+        'aud': AUDIENCE,
+        'iat': now,
+        'exp': now + 3600,
+    }
+
+    return jwt.encode(signer, payload).decode('utf-8')
+
+
+class Stub(object):
+    # Stands in for the google certificate and token endpoints and the
+    # firebase users tree, every simulated player has its own colour.
+
+    def __init__(self, cert, clients):
+        self.cert = cert
+        self.users = {uid(i): {'color': user_color(i)} for i in range(clients)}
+        self.app = web.Application()
+        self.app.router.add_get('/certs', self.certs)
+        self.app.router.add_post('/token', self.token)
+        self.app.router.add_get('/firebase/{path}', self.firebase)
+        self.handler = None
+        self.server = None
+        self.url = None
+
+    async def certs(self, request):
+        return web.json_response({KEY_ID: self.cert},
+                                 headers={'Cache-Control': 'public, max-age=3600'})
+
+    async def token(self, request):
+        return web.json_response({'access_token': 'loadtest', 'expires_in': 3600,
+                                  'token_type': 'Bearer'})
+
+    async def firebase(self, request):
+        path = request.match_info['path'][:-len('.json')]
+        if not path:
+            return web.json_response(self.users)
+
+        return web.json_response(self.users.get(path))
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        self.handler = self.app.make_handler()
+        self.server = await loop.create_server(self.handler, '127.0.0.1', 0)
+        self.url = 'http://127.0.0.1:%s' % self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.handler.shutdown(1)
+
+
+class Server(object):
+    def __init__(self, port, env):
+        self.port = port
+        self.env = env
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', 'turg.main:app', '-t', '60',
+             '--bind', f'127.0.0.1:{self.port}', '--workers', str(args.workers),
+             '--worker-class', 'aiohttp.worker.GunicornUVLoopWebWorker'],
+            cwd=ROOT, env=dict(os.environ, **self.env))
+
+    async def wait_ready(self, session, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited with {self.process.returncode}")
+            try:
+                async with session.get(f'http://127.0.0.1:{self.port}/v1/metrics') as res:
+                    if res.status == 200:
+                        return
+            except OSError:
+                pass
+            await asyncio.sleep(0.5)
+
+        raise RuntimeError("Server did not start in time")
+
+    def pids(self):
+        # gunicorn master and its workers
+        pids = [self.process.pid]
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as stat:
+                    ppid = int(stat.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            if ppid == self.process.pid:
+                pids.append(int(entry))
+
+        return pids
+
+    def rss(self):
+        total = 0
+        for pid in self.pids():
+            try:
+                with open(f'/proc/{pid}/status') as status:
+                    for line in status:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1]) * 1024
+            except OSError:
+                continue
+
+        return total
+
+    def stop(self):
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class Stats(object):
+    def __init__(self):
+        self.measuring = False
+        self.latency = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.sent = defaultdict(int)
+        self.received = 0
+        self.received_bytes = 0
+        self.lag = []
+        self.published = {}  # update id -> send time, for broadcast lag
+        self.connected = 0
+        self.failed = 0
+        self.rss = []
+
+
+class Player(object):
+    def __init__(self, index, token, stats):
+        self.index = index
+        self.token = token
+        self.stats = stats
+        self.pending = {}
+        self.seq = 0
+        self.voxels = []
+        row, column = divmod(index, max(1, int(args.clients ** 0.5)))
+        self.home = args.origin + column * args.spread, args.origin + row * args.spread
+
+    def request(self):
+        hx, hy = self.home
+
+        if random.random() >= args.update_ratio:
+            request_args = {'x': hx, 'y': hy, 'range': args.range}
+            if args.stream:
+                request_args['stream'] = True
+            return 'range', request_args
+
+        # Grow own buildings: a new ground voxel or one on top of an existing one
+        if self.voxels and random.random() < 0.5:
+            x, y, z = random.choice(self.voxels)
+            z += 1
+        else:
+            half = args.spread // 2 - 2
+            x, y, z = hx + random.randint(-half, half), hy + random.randint(-half, half), 0
+
+        return 'update', {'x': x, 'y': y, 'z': z}
+
+    async def send(self, ws):
+        kind, request_args = self.request()
+        self.seq += 1
+        request_id = f'{self.index}-{self.seq}'
+        now = time.perf_counter()
+
+        self.pending[request_id] = kind, now, request_args, self.stats.measuring
+        if kind == 'update':
+            self.stats.published[request_id] = now
+        if self.stats.measuring:
+            self.stats.sent[kind] += 1
+
+        await ws.send_str(json.dumps({'type': kind, 'id': request_id, 'args': request_args}))
+
+    def receive(self, data, size):
+        now = time.perf_counter()
+        stats = self.stats
+
+        if isinstance(data, bytes):
+            _, meta = decode_range(data)
+            message = {'meta': meta}
+        else:
+            message = json.loads(data)
+            meta = message.get('meta') or {}
+        # Streamed range replies are complete with their last page
+        last = meta.get('end', True)
+
+        if not stats.measuring:
+            if last:
+                self.pending.pop(meta.get('id'), None)
+            return
+
+        stats.received += 1
+        stats.received_bytes += size
+        request_id = meta.get('id')
+
+        if request_id in self.pending and last:
+            kind, sent, request_args, measured = self.pending.pop(request_id)
+            if measured:
+                stats.latency[kind].append(now - sent)
+
+            if 'error' in message:
+                stats.errors[kind] += 1
+            elif kind == 'update':
+                self.voxels.append((request_args['x'], request_args['y'], request_args['z']))
+
+        elif meta.get('type') == 'update' and request_id in stats.published:
+            stats.lag.append(now - stats.published[request_id])
+
+    async def run(self, session, url, stop_at):
+        try:
+            ws = await session.ws_connect(f'{url}?token={self.token}&protocol={args.protocol}')
+        except Exception:
+            self.stats.failed += 1
+            return
+
+        self.stats.connected += 1
+        reader = asyncio.ensure_future(self.read(ws))
+
+        try:
+            while time.monotonic() < stop_at and not ws.closed:
+                await asyncio.sleep(random.expovariate(args.rate))
+                await self.send(ws)
+        finally:
+            await ws.close()
+            reader.cancel()
+
+    async def read(self, ws):
+        async for msg in ws:
+            if msg.type in (WSMsgType.TEXT, WSMsgType.BINARY):
+                self.receive(msg.data, len(msg.data))
+
+
+async def sample_rss(server, stats):
+    while True:
+        stats.rss.append(server.rss())
+        await asyncio.sleep(1)
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(stats, elapsed):
+    requests = {}
+    for kind in sorted(set(stats.sent) | set(stats.latency)):
+        requests[kind] = dict(percentiles(stats.latency[kind]),
+                              sent=stats.sent[kind],
+                              errors=stats.errors[kind],
+                              per_second=len(stats.latency[kind]) / elapsed)
+
+    return {
+        'started': datetime.datetime.utcnow().isoformat(),
+        'revision': revision(),
+        'config': vars(args),
+        'elapsed': elapsed,
+        'clients': {'connected': stats.connected, 'failed': stats.failed},
+        'throughput': {
+            'sent_per_second': sum(stats.sent.values()) / elapsed,
+            'received_per_second': stats.received / elapsed,
+            'received_bytes_per_second': stats.received_bytes / elapsed,
+        },
+        'requests': requests,
+        'broadcast_lag': percentiles(stats.lag),
+        'rss': {
+            'start': stats.rss[0] if stats.rss else None,
+            'peak': max(stats.rss) if stats.rss else None,
+            'end': stats.rss[-1] if stats.rss else None,
+        },
+    }
+
+
+async def main():
+    port = args.port or free_port()
+    db = MongoClient(args.turg_db).get_default_database()
+    # Only ever drops a db that is named as a benchmark one
+    if not db.name.startswith(BENCH_DB_PREFIX) and not args.keep_db:
+        parser.error(f"{db.name} is not a benchmark db, its name must start with "
+                     f"{BENCH_DB_PREFIX} or pass --keep-db to use it without dropping it")
+    if not args.keep_db:
+        db.client.drop_database(db.name)
+
+    with tempfile.TemporaryDirectory() as directory:
+        private_key, cert = make_keys(directory)
+    signer = crypt.RSASigner.from_string(private_key, KEY_ID)
+
+    stub = Stub(cert, args.clients)
+    await stub.start()
+
+    server = Server(port, {
+        'CONFIG_FILE': os.path.join(ROOT, 'config.yml'),
+        'MONGODB_URI': args.turg_db,
+        'JWT_CERTS_URL': f'{stub.url}/certs',
+        'FIREBASE_URL': f'{stub.url}/firebase',
+        'SERVICE_ACCOUNT': json.dumps({
+            'type': 'service_account',
+            'project_id': 'loadtest',
+            'private_key_id': KEY_ID,
+            'private_key': private_key,
+            'client_email': 'loadtest@loadtest.iam.gserviceaccount.com',
+            'client_id': 'loadtest',
+            'token_uri': f'{stub.url}/token',
+        }),
+        'RATE_LIMIT': '1000000',
+        'RATE_LIMIT_BURST': '1000000',
+        'LOG_LEVEL': 'WARNING',
+    })
+    server.start()
+
+    stats = Stats()
+    sampler = None
+
+    try:
+        async with ClientSession() as session:
+            await server.wait_ready(session)
+            print(f"Server is up on port {port}, starting {args.clients} players")
+
+            url = f'ws://127.0.0.1:{port}/v1/ws/'
+            stop_at = time.monotonic() + args.warmup + args.duration
+            players = [Player(i, make_token(signer, i), stats) for i in range(args.clients)]
+            tasks = [asyncio.ensure_future(player.run(session, url, stop_at))
+                     for player in players]
+
+            await asyncio.sleep(args.warmup)
+            stats.measuring = True
+            sampler = asyncio.ensure_future(sample_rss(server, stats))
+            started = time.monotonic()
+            print(f"Measuring for {args.duration}s")
+
+            await asyncio.gather(*tasks)
+            elapsed = time.monotonic() - started
+            stats.measuring = False
+    finally:
+        if sampler is not None:
+            sampler.cancel()
+        server.stop()
+        await stub.stop()
+        if not args.keep_db:
+            db.client.drop_database(db.name)
+
+    results = report(stats, elapsed)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+
+    for kind, result in results['requests'].items():
+        if result['count']:
+            print(f"{kind}: {result['per_second']:.1f}/s, p50 {result['p50'] * 1000:.1f}ms, "
+                  f"p95 {result['p95'] * 1000:.1f}ms, p99 {result['p99'] * 1000:.1f}ms, "
+                  f"{result['errors']} errors")
+    lag = results['broadcast_lag']
+    if lag['count']:
+        print(f"broadcast lag: p50 {lag['p50'] * 1000:.1f}ms, p99 {lag['p99'] * 1000:.1f}ms")
+    print(f"peak rss: {results['rss']['peak']} bytes, results written to {args.output}")
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
@@ -1,13 +1,19 @@
 import argparse
-import binascii
 import datetime
 import os
 import struct
 import sys
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import numpy as np
 from colors import color
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import OperationFailure
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from turg.morton import INDEXES, STAMP, chunk_key  # noqa: E402
 
 # Qubicle Binary is an exchange format that stores voxel data in binary form.
 # http://www.minddesk.com/wiki/index.php?title=Qubicle_Constructor_1:Data_Exchange_With_Qubicle_Binary
@@ -18,6 +24,13 @@ parser.add_argument("--x", help="X coordinate", default=0, type=int)
 parser.add_argument("--y", help="Y coordinate", default=0, type=int)
 parser.add_argument("--z", help="Z coordinate", default=0, type=int)
 parser.add_argument("--turg-db", help="theurbn db", default='', type=str)
+parser.add_argument("--hidden", help="also drop voxels not exposed to outside air",
+                    action='store_true')
+parser.add_argument("--batch-size", help="voxels per write", default=1000, type=int)
+parser.add_argument("--workers", help="parallel connections", default=4, type=int)
+parser.add_argument("--chunk-size", help="server chunk_size, for chunk keys", default=16, type=int)
+parser.add_argument("--checkpoint", help="progress file, next to the model by default",
+                    default='', type=str)
 args = parser.parse_args()
 
 SPOT_FLAG_COLOR = '#ff00ff'
@@ -30,127 +43,275 @@ SPOT_NAMES = ['Apocalypse Peaks', 'Blow Me Down', 'Cockburn Town',
               'Unalaska', 'Wankum', 'Zigzag']
 
 
-def voxel_id(x, y, z):
-    return f'{x}_{y}_{z}'
+NEXT_SLICE_FLAG = 6
+CODE_FLAG = 2
+
+
+def decode_rle(data, offset, size):
+    # Compressed matrices store every z slice as a stream of colours where
+    # CODE_FLAG, count, colour is a run, NEXT_SLICE_FLAG ends the slice.
+    words = np.frombuffer(data, dtype='<u4', count=(len(data) - offset) // 4,
+                          offset=offset).tolist()
+    slices = []
+    i = 0
+
+    for _ in range(size[2]):
+        values, counts = [], []
+        while True:
+            word = words[i]
+            i += 1
+            if word == NEXT_SLICE_FLAG:
+                break
+            if word == CODE_FLAG:
+                counts.append(words[i])
+                values.append(words[i + 1])
+                i += 2
+            else:
+                counts.append(1)
+                values.append(word)
+        slices.append(np.repeat(np.array(values, dtype=np.uint32), counts))
+
+    return np.concatenate(slices).reshape(size[2], size[1], size[0]), offset + i * 4
 
 
 def qb_decode(qb_file_path):
+    # Returns voxel coordinates as an (n, 3) array, their colour indices
+    # into the palette and the palette of '#rrggbb' colours.
     print(f"Loading {qb_file_path}")
     with open(qb_file_path, 'rb') as qbfile:
-        version = struct.unpack("I", qbfile.read(4))[0]
-        if version != 0x0101:  # 1.1.0.0
-            print("Unsupported QB format detected")
-            sys.exit(1)
-        color_format = 'RGBA' if struct.unpack("I", qbfile.read(4))[0] is 0 else 'BGRA'
-        if color_format is not 'RGBA':
-            print("Unsupported colour {color_format} format detected")
-            sys.exit(1)
-        z_axis_orientation = struct.unpack("I", qbfile.read(4))[0]
-        is_compressed = struct.unpack("I", qbfile.read(4))[0]
+        data = qbfile.read()
+
+    version, color_format, z_axis_orientation, is_compressed, _, num_matrices = \
+        struct.unpack_from("<6I", data)  # _ is Visibility-Mask encoded
+    if version != 0x0101:  # 1.1.0.0
+        print("Unsupported QB format detected")
+        sys.exit(1)
+    print(f"Found {num_matrices} matrices")
+
+    offset = 24
+    coords, colors = [], []
+
+    for _ in range(num_matrices):
+        name_length = data[offset]
+        name = data[offset + 1:offset + 1 + name_length]
+        offset += 1 + name_length
+        size = struct.unpack_from("<3I", data, offset)
+        offset += 24  # size and position
+        print(f"Loading Matrix {name} with size {size}")
+
         if is_compressed:
-            print("Unsupported RLE compression detected")
-            sys.exit(1)
-        _ = struct.unpack("I", qbfile.read(4))[0]  # Visibility-Mask encoded
-        num_matrices = struct.unpack("I", qbfile.read(4))[0]
-        print(f"Found {num_matrices} matrices")
-
-        colors_palette = []
-        object_dict = {}
-
-        for _ in range(num_matrices):
-            name_length = struct.unpack("B", qbfile.read(1))[0]
-            name = struct.unpack(str(name_length) + "s", qbfile.read(name_length))[0]
-            size = struct.unpack("III", qbfile.read(12))
-            print(f"Loading Matrix {name} with size {size}")
-
-            _ = struct.unpack("iii", qbfile.read(12))
-            for z in range(size[2]):
-                for y in range(size[1]):
-                    for x in range(size[0]):
-                        color = struct.unpack("I", qbfile.read(4))[0]
-                        if color:
-                            dec_rgb = [(color >> (8 * i)) & 255 for i in range(3)]
-                            hex_color = "#{}".format(
-                                binascii.hexlify(struct.pack('BBB', *dec_rgb)).decode(
-                                    encoding='UTF-8'))
-                            if hex_color not in colors_palette:
-                                colors_palette.append(hex_color)
-                            if z_axis_orientation:
-                                object_dict[voxel_id(x, z, y)] = [x, z, y, hex_color]
-                            else:
-                                object_dict[voxel_id(x, y, z)] = [x, y, z, hex_color]
-        return object_dict, colors_palette
-
-
-def optimise(object_dict):
+            matrix, offset = decode_rle(data, offset, size)
+        else:
+            count = size[0] * size[1] * size[2]
+            matrix = np.frombuffer(data, dtype='<u4', count=count, offset=offset).reshape(
+                size[2], size[1], size[0])
+            offset += count * 4
+
+        z, y, x = np.nonzero(matrix)
+        coords.append(np.stack((x, z, y) if z_axis_orientation else (x, y, z), axis=1))
+        colors.append(matrix[z, y, x])
+
+    coords = np.concatenate(coords) if coords else np.empty((0, 3), dtype=np.int64)
+    colors = np.concatenate(colors) if colors else np.empty(0, dtype=np.uint32)
+
+    # Later matrices overwrite earlier ones
+    _, last = np.unique(coords[::-1], axis=0, return_index=True)
+    keep = np.sort(len(coords) - 1 - last)
+    coords, colors = coords[keep], colors[keep]
+
+    # RGBA keeps red in the low byte, BGRA keeps blue there
+    low, middle, high = colors & 255, (colors >> 8) & 255, (colors >> 16) & 255
+    if color_format == 0:
+        rgb = low << 16 | middle << 8 | high
+    else:
+        rgb = high << 16 | middle << 8 | low
+
+    # Palette in order of first appearance
+    values, first, inverse = np.unique(rgb, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    palette = [f'#{value:06x}' for value in values[order].tolist()]
+
+    return coords, rank[inverse], palette
+
+
+def occupancy(coords):
+    # Dense occupancy grid with one empty cell of padding on every side,
+    # and the grid index of every voxel
+    cells = coords - coords.min(axis=0) + 1
+    grid = np.zeros(cells.max(axis=0) + 2, dtype=bool)
+    grid[tuple(cells.T)] = True
+
+    return grid, cells
+
+
+def neighbours_all(grid):
+    # Cells whose six face neighbours are all set, the border stays False
+    inner = np.zeros_like(grid)
+    inner[1:-1, 1:-1, 1:-1] = (grid[2:, 1:-1, 1:-1] & grid[:-2, 1:-1, 1:-1] &
+                               grid[1:-1, 2:, 1:-1] & grid[1:-1, :-2, 1:-1] &
+                               grid[1:-1, 1:-1, 2:] & grid[1:-1, 1:-1, :-2])
+    return inner
+
+
+def neighbours_any(grid):
+    # Cells with at least one set face neighbour
+    near = np.zeros_like(grid)
+    near[1:] |= grid[:-1]
+    near[:-1] |= grid[1:]
+    near[:, 1:] |= grid[:, :-1]
+    near[:, :-1] |= grid[:, 1:]
+    near[:, :, 1:] |= grid[:, :, :-1]
+    near[:, :, :-1] |= grid[:, :, 1:]
+    return near
+
+
+def exterior(grid):
+    # Empty cells connected to the outside, flooded from the padding
+    air = ~grid
+    outside = np.zeros_like(grid)
+    outside[0], outside[-1] = air[0], air[-1]
+    outside[:, 0], outside[:, -1] = air[:, 0], air[:, -1]
+    outside[:, :, 0], outside[:, :, -1] = air[:, :, 0], air[:, :, -1]
+
+    while True:
+        grown = (outside | neighbours_any(outside)) & air
+        if np.array_equal(grown, outside):
+            return outside
+        outside = grown
+
+
+def optimise(coords, colors, hidden=False):
+    # Drops voxels enclosed on all six sides, with hidden=True also every voxel
+    # that does not touch the air outside the model (walls of closed rooms).
     print("Optimising voxels...")
 
-    def neighbour(voxel, x_diff, y_diff, z_diff):
-        return voxel_id(voxel[0] + x_diff,
-                        voxel[1] + y_diff,
-                        voxel[2] + z_diff)
+    if not len(coords):
+        return coords, colors
+
+    grid, cells = occupancy(coords)
+    index = tuple(cells.T)
+
+    if hidden:
+        keep = neighbours_any(exterior(grid))[index]
+    else:
+        keep = ~neighbours_all(grid)[index]
+
+    gone = len(coords) - int(keep.sum())
+    print("Optimised away {0} voxels ({1:.2f}%)".format(gone, gone / len(coords) * 100))
 
-    neighbours = (
-        (1, 0, 0),
-        (0, 1, 0),
-        (0, 0, 1),
-        (-1, 0, 0),
-        (0, -1, 0),
-        (0, 0, -1),
-    )
+    return coords[keep], colors[keep]
 
-    def is_surrounded(voxel):
-        if all(map(lambda n: neighbour(voxel, *n) in object_dict, neighbours)):
-            return True
 
-        return False
+def spot_names(colors, palette):
+    # Flags get names in a fixed order so a resumed import names them the same
+    if SPOT_FLAG_COLOR not in palette:
+        return {}
 
-    optimised = {}
+    flags = np.flatnonzero(colors == palette.index(SPOT_FLAG_COLOR)).tolist()
+    return dict(zip(flags, SPOT_NAMES))
 
-    for v_id, voxel in object_dict.items():
-        if not is_surrounded(voxel):
-            optimised[v_id] = voxel
 
-    gone = len(object_dict) - len(optimised)
-    try:
-        gone_relative = 100 - len(optimised) / len(object_dict) * 100
-    except ZeroDivisionError:
-        gone_relative = 0
+class Checkpoint(object):
+    # Batches already written, kept in a file next to the model. It only
+    # applies to the same import (model, position, options, batch size).
 
-    print("Optimised away {0} voxels ({1:.2f}%)".format(gone, gone_relative))
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.done = set()
 
-    return optimised
+        try:
+            with open(path) as checkpoint:
+                data = json.load(checkpoint)
+        except (OSError, ValueError):
+            return
 
+        if data.get('key') == key:
+            self.done = set(data['done'])
 
-def urb_ws_plotter(object_dict, palette, pos, turg_db):
-    print(f"Object contains {len(object_dict)} voxels")
+    def add(self, batch):
+        self.done.add(batch)
+
+        with open(self.path + '.tmp', 'w') as checkpoint:
+            json.dump({'key': self.key, 'done': sorted(self.done)}, checkpoint)
+        os.replace(self.path + '.tmp', self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def upsert_batch(collection, coords, colors, names, palette, start):
+    # Keyed on coordinates so writing a batch twice leaves the same documents
+    now = datetime.datetime.utcnow()
+    requests = [
+        UpdateOne({'x': x, 'y': y, 'z': z},
+                  {'$set': {'x': x, 'y': y, 'z': z, 'owner': palette[owner],
+                            'name': names.get(start + i), 'updated': now,
+                            'key': chunk_key(x, y, z, args.chunk_size)},
+                   '$currentDate': STAMP},
+                  upsert=True)
+        for i, ((x, y, z), owner) in enumerate(zip(coords.tolist(), colors.tolist()))
+    ]
+    collection.bulk_write(requests, ordered=False)
+
+    return len(requests)
+
+
+def urb_ws_plotter(coords, colors, palette, pos, turg_db, hidden=False):
+    print(f"Object contains {len(coords)} voxels")
     print(f"Connecting with {turg_db}")
     print(f"Plot start position {pos}")
     [print(color(chr(9608), chr_color), end='') for chr_color in palette]
     print("Colours list for Firebase DB")
     print(json.dumps([{i[1:]: {'color': i} for i in palette}]))
 
-    db = MongoClient(turg_db).get_database()
+    coords, colors = optimise(coords, colors, hidden)
+    coords = coords + pos
+    names = spot_names(colors, palette)
+    for i, name in names.items():
+        print(f"Spot {name} at {'x'.join(map(str, coords[i] - pos))}")
 
-    def docs():
-        for _, o in optimise(object_dict).items():
-            if o[3] == SPOT_FLAG_COLOR:
-                name = SPOT_NAMES.pop(0)
-                print(f"Spot {name} at {o[0]}x{o[1]}x{o[2]}")
-            else:
-                name = None
-            yield {'x': o[0] + pos[0],
-                   'y': o[1] + pos[1],
-                   'z': o[2] + pos[2],
-                   'owner': o[3],
-                   'name': name,
-                   'updated': datetime.datetime.now()}
+    batches = range(0, len(coords), args.batch_size)
+    checkpoint = Checkpoint(args.checkpoint or f'{args.src}.{pos[0]}_{pos[1]}_{pos[2]}.checkpoint',
+                            {'src': os.path.abspath(args.src), 'pos': list(pos),
+                             'hidden': hidden, 'count': len(coords),
+                             'batch_size': args.batch_size})
+    pending = [start for start in batches if start not in checkpoint.done]
+    written = sum(len(coords[start:start + args.batch_size])
+                  for start in batches if start in checkpoint.done)
+    if written:
+        print(f"Resuming, {written} voxels already written")
+
+    client = MongoClient(turg_db, maxPoolSize=args.workers)
+    collection = client.get_database().data
+    for keys, options in INDEXES:
+        try:
+            collection.create_index(keys, **options)
+        except OperationFailure as e:
+            print(f"Can't create index {keys}, run python -m turg.migrate: {e}")
+
+    with ThreadPoolExecutor(args.workers) as executor:
+        futures = {
+            executor.submit(upsert_batch, collection,
+                            coords[start:start + args.batch_size],
+                            colors[start:start + args.batch_size],
+                            names, palette, start): start
+            for start in pending
+        }
+        for future in as_completed(futures):
+            written += future.result()
+            checkpoint.add(futures[future])
+            print(f"{written}/{len(coords)} voxels")
 
-    result = db.data.insert_many(docs(), ordered=False)
-    print(f"Inserted {len(result.inserted_ids)} voxels")
+    checkpoint.remove()
+    client.close()
+    print(f"Upserted {len(coords)} voxels")
 
 
 if __name__ == '__main__':
-    objects, palette = qb_decode(os.path.expanduser(args.src))
+    coords, colors, palette = qb_decode(os.path.expanduser(args.src))
     pos = (args.x, args.y, args.z)
-    urb_ws_plotter(objects, palette, pos, args.turg_db)
+    urb_ws_plotter(coords, colors, palette, pos, args.turg_db, args.hidden)
@@ -0,0 +1,76 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tests.legacy_rules import legacy_check, same_outcome  # noqa: E402
+from turg import rules  # noqa: E402
+from turg.models import Voxel  # noqa: E402
+from turg.world import World  # noqa: E402
+
+# Compares turg.rules.check with the placement checks over neighbour records
+# on a random dense world: every outcome must match, then both are timed.
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--size", help="side of the built up area", default=64, type=int)
+parser.add_argument("--height", help="max building height", default=12, type=int)
+parser.add_argument("--owners", help="number of players", default=8, type=int)
+parser.add_argument("--flags", help="number of flags", default=20, type=int)
+parser.add_argument("--placements", help="placements to check", default=5000, type=int)
+parser.add_argument("--seed", help="random seed", default=1, type=int)
+args = parser.parse_args()
+
+
+def build_world():
+    world = World()
+    owners = [f'#{i + 1:06x}' for i in range(args.owners)]
+
+    for x in range(args.size):
+        for y in range(args.size):
+            owner = owners[(x // 8 + y // 8) % len(owners)]
+            for z in range(random.randint(0, args.height)):
+                world.set(x, y, z, owner)
+
+    for i in range(args.flags):
+        x, y = random.randrange(args.size), random.randrange(args.size)
+        world.set(x, y, random.randint(0, args.height), '#ff00ff', f'Flag {i}')
+
+    return world, owners
+
+
+def main():
+    random.seed(args.seed)
+    world, owners = build_world()
+    print(f"World of {len(world)} voxels")
+
+    voxels = [Voxel(random.randrange(-2, args.size + 2), random.randrange(-2, args.size + 2),
+                    random.randint(0, args.height + 2), random.choice(owners))
+              for _ in range(args.placements)]
+
+    start = time.perf_counter()
+    legacy = [legacy_check(world, voxel) for voxel in voxels]
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectorised = [rules.check(world, voxel.x, voxel.y, voxel.z, voxel.owner) for voxel in voxels]
+    vectorised_time = time.perf_counter() - start
+
+    outcomes = {}
+    for voxel, old, new in zip(voxels, legacy, vectorised):
+        if not same_outcome(world, voxel, old, new):
+            print(f"Mismatch for {voxel}: {old} != {new}")
+            sys.exit(1)
+        outcomes[new[0]] = outcomes.get(new[0], 0) + 1
+
+    print(f"Outcomes: {outcomes}")
+    print(f"Neighbour records: {legacy_time / len(voxels) * 1e6:.1f}us per placement")
+    print(f"Vectorised:        {vectorised_time / len(voxels) * 1e6:.1f}us per placement")
+    print(f"Speedup: {legacy_time / vectorised_time:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
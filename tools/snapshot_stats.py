@@ -0,0 +1,62 @@
+import argparse
+import datetime
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from turg.snapshot import Snapshot  # noqa: E402
+
+# Summary of a world snapshot file read in place through mmap:
+# voxels per owner, flags and the built up bounding box.
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--src", help="snapshot file location", type=str)
+parser.add_argument("--top", help="number of owners to list", default=20, type=int)
+args = parser.parse_args()
+
+
+def main():
+    with Snapshot(args.src) as snapshot:
+        taken = datetime.datetime.utcfromtimestamp(snapshot.taken)
+        print(f"Snapshot of world version {snapshot.version} taken {taken:%Y-%m-%d %H:%M:%S}")
+        print(f"{len(snapshot)} voxels in {len(snapshot.index)} chunks of "
+              f"{snapshot.chunk_size}, {len(snapshot.palette)} owners")
+
+        size = snapshot.chunk_size
+        owners = np.zeros(len(snapshot.palette), dtype=np.int64)
+        flags = []
+        low, high = None, None
+
+        for cx, cy, cz in snapshot.index:
+            # The views keep the file mapped, they are dropped before the next chunk
+            views = snapshot.arrays((cx, cy, cz))
+            owners += np.bincount(np.frombuffer(views[3], dtype=np.uint16),
+                                  minlength=len(owners))
+            offsets = np.frombuffer(views[2], dtype=np.uint16).astype(np.int64)
+            del views
+
+            rest, x = np.divmod(offsets, size)
+            z, y = np.divmod(rest, size)
+            coords = np.stack((x + cx * size, y + cy * size, z + cz * size), axis=1)
+            low = coords.min(axis=0) if low is None else np.minimum(low, coords.min(axis=0))
+            high = coords.max(axis=0) if high is None else np.maximum(high, coords.max(axis=0))
+
+            for slot, name in snapshot.names((cx, cy, cz)).items():
+                flags.append((name, *coords[slot].tolist()))
+
+        if low is not None:
+            print(f"Bounding box {low.tolist()} - {high.tolist()}")
+
+        for owner in np.argsort(owners)[::-1][:args.top]:
+            print(f"{snapshot.palette[owner]} {owners[owner]}")
+
+        for name, x, y, z in sorted(flags):
+            print(f"Flag {name} at {x}x{y}x{z}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import re
+import time
+from collections import OrderedDict
+
+from aiohttp import ClientSession
+
+from turg.logger import getLogger
+
+logger = getLogger(__name__)
+
+MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+class CertManager(object):
+    # JWT signing certificates, refreshed in the background as advertised by
+    # the Cache-Control header. The last good set is kept when a refresh fails.
+
+    def __init__(self, url, min_refresh=60, max_refresh=6 * 3600, retry_interval=30):
+        self.url = url
+        self.min_refresh = min_refresh
+        self.max_refresh = max_refresh
+        self.retry_interval = retry_interval
+        self.certs = None
+        self.fetched = None
+        self.task = None
+
+    def refresh_in(self, headers):
+        match = MAX_AGE.search(headers.get('Cache-Control', ''))
+        if not match:
+            return self.min_refresh
+
+        max_age = int(match.group(1)) - int(headers.get('Age', 0))
+
+        return min(max(max_age, self.min_refresh), self.max_refresh)
+
+    async def refresh(self):
+        async with ClientSession() as session:
+            async with session.get(self.url) as res:
+                res.raise_for_status()
+                certs = await res.json()
+                delay = self.refresh_in(res.headers)
+
+        if not certs:
+            raise ValueError("Empty jwt certs response")
+
+        self.certs = certs
+        self.fetched = time.time()
+        logger.info("Load jwt certs: %s, next refresh in %ss", list(certs), delay)
+
+        return delay
+
+    async def start(self):
+        delay = await self.refresh()
+        self.task = asyncio.ensure_future(self.run(delay))
+
+    async def run(self, delay):
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                delay = await self.refresh()
+            except Exception:
+                logger.exception("Refresh jwt certs failed, keep certs from %s", self.fetched)
+                delay = self.retry_interval
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+class TokenCache(object):
+    # Bounded LRU of verified token payloads keyed by token hash,
+    # an entry is dropped once the token expires.
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(token):
+        if isinstance(token, str):
+            token = token.encode('utf-8')
+
+        return hashlib.sha256(token).digest()
+
+    def get(self, token):
+        key = self.key(token)
+        entry = self.entries.get(key)
+
+        if entry is None:
+            return None
+
+        payload, expires = entry
+        if expires <= time.time():
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return payload
+
+    def put(self, token, payload):
+        expires = payload.get('exp')
+        if not expires:
+            return
+
+        key = self.key(token)
+        self.entries[key] = payload, expires
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
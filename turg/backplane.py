@@ -0,0 +1,149 @@
+import asyncio
+import json
+import uuid
+from collections import defaultdict, deque
+
+from bson import ObjectId
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid
+
+from turg.logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class Backplane(object):
+    # Pub/sub channel between server processes. Events are plain dicts,
+    # publish() delivers them to every other node's handlers, never back to
+    # the publishing node itself. Delivery is best effort, publish() never raises.
+
+    def __init__(self):
+        self.node = uuid.uuid4().hex
+        self.handlers = []
+
+    def subscribe(self, handler):
+        self.handlers.append(handler)
+
+    async def dispatch(self, event):
+        for handler in self.handlers:
+            try:
+                await handler(event)
+            except Exception:
+                logger.exception("Backplane handler failed for %s event", event.get('kind'))
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, event):
+        raise NotImplementedError
+
+
+class LocalBackplane(Backplane):
+    # Nodes living in the same process, joined by channel name
+    channels = defaultdict(list)
+
+    def __init__(self, channel='turg'):
+        super().__init__()
+        self.channel = channel
+
+    async def start(self):
+        LocalBackplane.channels[self.channel].append(self)
+
+    async def stop(self):
+        peers = LocalBackplane.channels[self.channel]
+        if self in peers:
+            peers.remove(self)
+
+    async def publish(self, event):
+        event = dict(event, node=self.node)
+
+        for peer in list(LocalBackplane.channels[self.channel]):
+            if peer is not self:
+                await peer.dispatch(dict(event))
+
+
+class MongoBackplane(Backplane):
+    # Events are appended to a capped collection that every node follows
+    # with a tailable cursor. Mongo stamps every event with its own clock,
+    # so clock skew between nodes can't make a node skip events. Events are
+    # stored as JSON, client supplied keys never become mongo field names.
+
+    def __init__(self, db, collection='events', size=16 * 1024 * 1024, retry_interval=0.5):
+        super().__init__()
+        self.db = db
+        self.collection = db[collection]
+        self.size = size
+        self.retry_interval = retry_interval
+        self.task = None
+        self.seen = deque(maxlen=1024)
+
+    async def start(self):
+        try:
+            await self.db.create_collection(self.collection.name, capped=True, size=self.size)
+        except CollectionInvalid:
+            pass
+
+        # A tailable cursor without any matching document dies right away
+        hello = await self.append({'kind': 'hello'})
+        since = (await self.collection.find_one({'_id': hello}))['at']
+        self.task = asyncio.ensure_future(self.tail(since))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def publish(self, event):
+        try:
+            return await self.append(event)
+        except Exception:
+            # The other nodes miss this one, the request that caused it still completes
+            logger.exception("Publishing %s event failed", event.get('kind'))
+
+    async def append(self, event):
+        _id = ObjectId()
+        await self.collection.update_one({'_id': _id}, {
+            '$set': {'node': self.node, 'kind': event.get('kind'), 'event': json.dumps(event)},
+            '$currentDate': {'at': {'$type': 'timestamp'}},
+        }, upsert=True)
+
+        return _id
+
+    async def tail(self, since):
+        while True:
+            cursor = self.collection.find({'at': {'$gte': since}},
+                                          cursor_type=CursorType.TAILABLE_AWAIT)
+            try:
+                while cursor.alive:
+                    if not await cursor.fetch_next:
+                        continue
+
+                    doc = cursor.next_object()
+                    since = doc['at']
+
+                    # Restarted cursors replay events stamped at the last seen time
+                    if doc['_id'] in self.seen:
+                        continue
+                    self.seen.append(doc['_id'])
+
+                    if (doc.get('node') != self.node and doc.get('kind') != 'hello' and
+                            'event' in doc):
+                        await self.dispatch(json.loads(doc['event']))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Backplane cursor failed")
+
+            await asyncio.sleep(self.retry_interval)
+
+
+def create_backplane(kind, db, collection='events', size=16 * 1024 * 1024):
+    if kind == 'local':
+        return LocalBackplane()
+    if kind == 'mongo':
+        return MongoBackplane(db, collection, size)
+
+    raise ValueError(f"Unknown backplane {kind}, expected local or mongo")
@@ -0,0 +1,142 @@
+import asyncio
+import json
+from collections import deque
+
+from turg.logger import getLogger, sampled
+
+logger = getLogger(__name__)
+hot_logger = sampled(logger)
+
+POLICIES = ('drop_oldest', 'coalesce', 'disconnect')
+
+
+class Outbox(object):
+    # Bounded queue of encoded frames for one socket, drained by its own writer
+    # task so a slow client never blocks the others.
+
+    def __init__(self, ws, broadcaster):
+        self.ws = ws
+        self.broadcaster = broadcaster
+        self.queue = deque()
+        self.pending = {}
+        self.ready = asyncio.Event()
+        self.task = asyncio.ensure_future(self.writer())
+
+    def __len__(self):
+        return len(self.queue)
+
+    def put(self, text, key=None):
+        stats = self.broadcaster.stats
+        policy = self.broadcaster.policy
+
+        if policy == 'coalesce' and key is not None and key in self.pending:
+            self.pending[key][1] = text
+            stats['coalesced'] += 1
+            return True
+
+        if len(self.queue) >= self.broadcaster.queue_size:
+            if policy == 'disconnect':
+                return False
+
+            self.forget(self.queue.popleft())
+            stats['dropped'] += 1
+
+        entry = [key, text]
+        self.queue.append(entry)
+        if policy == 'coalesce' and key is not None:
+            self.pending[key] = entry
+        self.ready.set()
+
+        return True
+
+    def forget(self, entry):
+        if entry[0] is not None and self.pending.get(entry[0]) is entry:
+            del self.pending[entry[0]]
+
+    async def writer(self):
+        while True:
+            if not self.queue:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+
+            entry = self.queue.popleft()
+            self.forget(entry)
+            text = entry[1]
+
+            if self.ws.closed:
+                continue
+
+            try:
+                await self.ws.send_str(text)
+                self.broadcaster.stats['sent'] += 1
+            except Exception as e:
+                hot_logger.warning("Failed to send update to socket %s: %r", id(self.ws), e)
+
+    def close(self):
+        self.task.cancel()
+        self.queue.clear()
+        self.pending.clear()
+
+
+class Broadcaster(object):
+    # Encodes every message once and fans the text out to per-socket outboxes.
+    # When an outbox is full the slow consumer policy decides what happens:
+    # drop_oldest evicts the oldest frame, coalesce replaces a queued frame with
+    # the same key (falling back to drop_oldest) and disconnect closes the socket.
+
+    def __init__(self, queue_size=256, policy='drop_oldest'):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow consumer policy {policy}, expected one of {POLICIES}")
+
+        self.queue_size = queue_size
+        self.policy = policy
+        self.outboxes = {}
+        self.stats = {
+            'messages': 0,
+            'sent': 0,
+            'dropped': 0,
+            'coalesced': 0,
+            'disconnected': 0,
+        }
+
+    def register(self, ws):
+        self.outboxes[id(ws)] = Outbox(ws, self)
+
+    def unregister(self, ws):
+        outbox = self.outboxes.pop(id(ws), None)
+
+        if outbox is not None:
+            outbox.close()
+
+    def publish(self, message, sockets, key=None):
+        text = json.dumps(message)
+        self.stats['messages'] += 1
+
+        for ws in sockets:
+            outbox = self.outboxes.get(id(ws))
+
+            if outbox is None:
+                continue
+
+            if not outbox.put(text, key):
+                logger.warning("Disconnect slow consumer %s", id(ws))
+                self.stats['disconnected'] += 1
+                self.unregister(ws)
+                asyncio.ensure_future(ws.close())
+
+    def queue_depth(self):
+        depths = [len(outbox) for outbox in self.outboxes.values()]
+
+        return sum(depths), max(depths, default=0)
+
+    def report(self):
+        total, deepest = self.queue_depth()
+
+        return dict(self.stats, sockets=len(self.outboxes),
+                    queued=total, max_queue_depth=deepest)
+
+    def close(self):
+        for outbox in self.outboxes.values():
+            outbox.close()
+        self.outboxes.clear()
@@ -0,0 +1,109 @@
+import time
+import zlib
+
+from aiohttp.web import WebSocketResponse
+
+# Ends every sync flush, aiohttp strips it from the frame
+FLUSH_TRAILER = b'\x00\x00\xff\xff'
+
+
+class CompressionPolicy(object):
+    # Decides per frame whether permessage-deflate is worth it: frames shorter
+    # than `threshold` bytes go out as they are, longer ones are deflated at `level`
+    # with a 2 ** wbits window. Stats weigh the bytes saved against the time
+    # spent deflating, which runs on the loop and so is CPU time.
+
+    def __init__(self, threshold=1024, level=6, wbits=15):
+        if not 0 <= level <= 9:
+            raise ValueError(f"Compression level {level} is not between 0 and 9")
+        if not 9 <= wbits <= 15:
+            raise ValueError(f"Compression window bits {wbits} are not between 9 and 15")
+
+        self.threshold = threshold
+        self.level = level
+        self.wbits = wbits
+        self.stats = {
+            'compressed': 0,
+            'uncompressed': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+        }
+        self.seconds = 0.0
+
+    def compress(self, size):
+        compress = size >= self.threshold
+        self.stats['compressed' if compress else 'uncompressed'] += 1
+
+        return compress
+
+    def compressor(self, wbits):
+        # Never wider than the window the client accepted, a smaller one always decodes
+        return MeteredCompressor(self, min(self.wbits, wbits))
+
+    def report(self):
+        return dict(self.stats, bytes_saved=self.stats['bytes_in'] - self.stats['bytes_out'])
+
+
+class MeteredCompressor(object):
+    # zlib compressor as the aiohttp websocket writer uses it, counting into the policy stats
+
+    def __init__(self, policy, wbits):
+        self.policy = policy
+        self.stats = policy.stats
+        self.compressobj = zlib.compressobj(policy.level, zlib.DEFLATED, -wbits)
+
+    def compress(self, data):
+        started = time.perf_counter()
+        compressed = self.compressobj.compress(data)
+        self.policy.seconds += time.perf_counter() - started
+        self.stats['bytes_in'] += len(data)
+        self.stats['bytes_out'] += len(compressed)
+
+        return compressed
+
+    def flush(self, mode=zlib.Z_FINISH):
+        started = time.perf_counter()
+        flushed = self.compressobj.flush(mode)
+        self.policy.seconds += time.perf_counter() - started
+        self.stats['bytes_out'] += len(flushed)
+        if flushed.endswith(FLUSH_TRAILER):
+            self.stats['bytes_out'] -= len(FLUSH_TRAILER)
+
+        return flushed
+
+
+class PolicyWebSocketResponse(WebSocketResponse):
+    # aiohttp 2.3 deflates every frame once the extension is negotiated and
+    # has no per message switch, so the writer's flag is set before each send.
+
+    def __init__(self, policy, **kwargs):
+        super().__init__(compress=True, **kwargs)
+        self.policy = policy
+        self.deflate = 0
+
+    async def prepare(self, request):
+        writer = await super().prepare(request)
+
+        # Negotiated window bits, 0 when the client did not offer deflate
+        if not self.deflate and self._writer.compress:
+            self.deflate = self._writer.compress
+            self._writer._compressobj = self.policy.compressor(self.deflate)
+
+        return writer
+
+    def choose(self, size):
+        if self.deflate and self._writer is not None:
+            self._writer.compress = self.deflate if self.policy.compress(size) else 0
+
+    def send_str(self, data):
+        if self._writer is None or not isinstance(data, str):
+            return super().send_str(data)
+
+        # The threshold is in bytes, the text is encoded once here instead of in the writer
+        data = data.encode('utf-8')
+        self.choose(len(data))
+        return self._writer.send(data, binary=False)
+
+    def send_bytes(self, data):
+        self.choose(len(data))
+        return super().send_bytes(data)
@@ -1,3 +1,4 @@
+import json
 import os
 
 import yaml
@@ -14,6 +15,13 @@ def str2bool(val):
     return val
 
 
+def str2dict(val):
+    if isinstance(val, str):
+        return json.loads(val)
+
+    return dict(val)
+
+
 def get_from_env_or_config(config, param, default=None, param_type=None, error=None):
     if default and not param_type:
         param_type = type(default)
@@ -36,11 +44,45 @@ class Config(object):
     max_z = None
     ping_interval = None
     service_account = None
+    firebase_url = None
+    firebase_refresh_interval = None
+    firebase_negative_ttl = None
     rate_limit = None
+    rate_limit_burst = None
+    rate_limit_costs = None
+    rate_limit_store = None
+    rate_limit_sync_interval = None
     max_range = None
+    range_page_size = None
     jwt_certs_url = None
+    jwt_refresh_min = None
+    jwt_refresh_max = None
+    jwt_retry_interval = None
+    jwt_cache_size = None
     cache_seconds = None
+    tile_size = None
+    tile_cache_bytes = None
+    snapshot_dir = None
+    snapshot_interval = None
+    snapshot_keep = None
+    snapshot_replay_margin = None
+    log_level = None
+    log_levels = None
+    log_sample_rate = None
     cors = None
+    chunk_size = None
+    aoi_cell_size = None
+    send_queue_size = None
+    ws_compress_threshold = None
+    ws_compress_level = None
+    ws_compress_wbits = None
+    slow_consumer_policy = None
+    write_batch_size = None
+    write_flush_interval = None
+    leaderboard_push_interval = None
+    backplane = None
+    backplane_collection = None
+    backplane_size = None
 
     def __init__(self):
         Config.load()
@@ -64,9 +106,51 @@ class Config(object):
         Config.max_z = get_from_env_or_config(config, 'max_z', 100)
         Config.ping_interval = get_from_env_or_config(config, 'ping_interval', 20)
         Config.rate_limit = get_from_env_or_config(config, 'rate_limit', 100)
+        Config.rate_limit_burst = get_from_env_or_config(config, 'rate_limit_burst',
+                                                         Config.rate_limit)
+        Config.rate_limit_costs = get_from_env_or_config(
+            config, 'rate_limit_costs', {'update': 1, 'range': 0.25, 'leaderboard': 0.25},
+            param_type=str2dict)
+        Config.rate_limit_store = get_from_env_or_config(config, 'rate_limit_store', 'local')
+        Config.rate_limit_sync_interval = get_from_env_or_config(
+            config, 'rate_limit_sync_interval', 1.0)
         Config.max_range = get_from_env_or_config(config, 'max_range', 100)
+        Config.range_page_size = get_from_env_or_config(config, 'range_page_size', 1000)
         Config.cache_seconds = get_from_env_or_config(config, 'cache_seconds', 1)
         Config.cors = get_from_env_or_config(config, 'cors_host', '*')
+        Config.chunk_size = get_from_env_or_config(config, 'chunk_size', 16)
+        Config.aoi_cell_size = get_from_env_or_config(config, 'aoi_cell_size', 32)
+        Config.send_queue_size = get_from_env_or_config(config, 'send_queue_size', 256)
+        Config.ws_compress_threshold = get_from_env_or_config(config, 'ws_compress_threshold',
+                                                              1024)
+        Config.ws_compress_level = get_from_env_or_config(config, 'ws_compress_level', 6)
+        Config.ws_compress_wbits = get_from_env_or_config(config, 'ws_compress_wbits', 15)
+        Config.slow_consumer_policy = get_from_env_or_config(config, 'slow_consumer_policy',
+                                                             'drop_oldest')
+        Config.write_batch_size = get_from_env_or_config(config, 'write_batch_size', 200)
+        Config.write_flush_interval = get_from_env_or_config(config, 'write_flush_interval', 0.02)
+        Config.leaderboard_push_interval = get_from_env_or_config(
+            config, 'leaderboard_push_interval', 1.0)
+        Config.backplane = get_from_env_or_config(config, 'backplane', 'local')
+        Config.backplane_collection = get_from_env_or_config(config, 'backplane_collection',
+                                                             'events')
+        Config.backplane_size = get_from_env_or_config(config, 'backplane_size', 16 * 1024 * 1024)
+        Config.tile_size = get_from_env_or_config(config, 'tile_size', 16)
+        Config.tile_cache_bytes = get_from_env_or_config(config, 'tile_cache_bytes',
+                                                         64 * 1024 * 1024)
+        Config.snapshot_dir = get_from_env_or_config(config, 'snapshot_dir', '')
+        Config.snapshot_interval = get_from_env_or_config(config, 'snapshot_interval', 300)
+        Config.snapshot_keep = get_from_env_or_config(config, 'snapshot_keep', 2)
+        Config.snapshot_replay_margin = get_from_env_or_config(config, 'snapshot_replay_margin', 60)
+        Config.log_level = get_from_env_or_config(config, 'log_level', 'DEBUG')
+        Config.log_levels = get_from_env_or_config(config, 'log_levels', {}, param_type=str2dict)
+        Config.log_sample_rate = get_from_env_or_config(config, 'log_sample_rate', 10)
+
+        Config.firebase_url = get_from_env_or_config(config, 'firebase_url',
+                                                     'https://theurbngame.firebaseio.com')
+        Config.firebase_refresh_interval = get_from_env_or_config(
+            config, 'firebase_refresh_interval', 300)
+        Config.firebase_negative_ttl = get_from_env_or_config(config, 'firebase_negative_ttl', 30)
 
         Config.service_account = get_from_env_or_config(
             config, 'service_account',
@@ -74,3 +158,7 @@ class Config(object):
         Config.jwt_certs_url = get_from_env_or_config(
             config, 'jwt_certs_url',
             error="jwt_certs_url parameter is missing in configuration")
+        Config.jwt_refresh_min = get_from_env_or_config(config, 'jwt_refresh_min', 60)
+        Config.jwt_refresh_max = get_from_env_or_config(config, 'jwt_refresh_max', 6 * 3600)
+        Config.jwt_retry_interval = get_from_env_or_config(config, 'jwt_retry_interval', 30)
+        Config.jwt_cache_size = get_from_env_or_config(config, 'jwt_cache_size', 10000)
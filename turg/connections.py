@@ -0,0 +1,89 @@
+import sys
+import time
+
+import attr
+
+
+@attr.s(slots=True)
+class Connection(object):
+    ws = attr.ib()
+    uid = attr.ib()
+    name = attr.ib()
+    color = attr.ib()
+    protocol = attr.ib(default='json')
+    viewport = attr.ib(default=None)
+    connected = attr.ib(default=attr.Factory(time.time))
+    stats = attr.ib(default=attr.Factory(lambda: {'received': 0, 'last_seen': None}))
+
+    def touch(self):
+        self.stats['received'] += 1
+        self.stats['last_seen'] = time.time()
+
+
+class Registry(object):
+    # All connections of this process, indexed by socket, colour and uid
+
+    def __init__(self):
+        self.by_socket = {}
+        self.by_color = {}
+        self.by_uid = {}
+
+    def __len__(self):
+        return len(self.by_socket)
+
+    def __iter__(self):
+        return iter(list(self.by_socket.values()))
+
+    def add(self, connection):
+        self.by_socket[id(connection.ws)] = connection
+        self.by_color[connection.color] = connection
+        self.by_uid[connection.uid] = connection
+
+        return connection
+
+    def remove(self, ws):
+        connection = self.by_socket.pop(id(ws), None)
+
+        if connection is None:
+            return None
+
+        # A newer connection of the same user may already own these keys
+        if self.by_color.get(connection.color) is connection:
+            del self.by_color[connection.color]
+        if self.by_uid.get(connection.uid) is connection:
+            del self.by_uid[connection.uid]
+
+        return connection
+
+    def get(self, ws):
+        return self.by_socket.get(id(ws))
+
+    def get_by_color(self, color):
+        return self.by_color.get(color)
+
+    def get_by_uid(self, uid):
+        return self.by_uid.get(uid)
+
+    def sockets(self):
+        return [connection.ws for connection in self.by_socket.values()]
+
+    def counts(self):
+        protocols = {}
+        for connection in self.by_socket.values():
+            protocols[connection.protocol] = protocols.get(connection.protocol, 0) + 1
+
+        return dict(connections=len(self.by_socket), users=len(self.by_uid),
+                    viewports=sum(1 for c in self.by_socket.values() if c.viewport),
+                    **protocols)
+
+    def memory(self):
+        # Approximate bytes held by the registry itself, sockets excluded
+        size = sum(sys.getsizeof(index) for index in
+                   (self.by_socket, self.by_color, self.by_uid))
+
+        for connection in self.by_socket.values():
+            size += sys.getsizeof(connection) + sys.getsizeof(connection.stats)
+            if connection.viewport:
+                size += sys.getsizeof(connection.viewport)
+
+        return size
@@ -1,5 +1,6 @@
 import asyncio
 import json
+import time
 
 from google.auth.transport.requests import AuthorizedSession
 from google.auth import jwt
@@ -38,23 +39,106 @@ def get_authed_session():
     return AuthorizedSession(credentials)
 
 
-async def update_users(app):
-    session = await run_async(get_authed_session)
-    res = await run_async(
-        session.get,
-        'https://theurbngame.firebaseio.com/.json'
-    )
-    data = res.json()
-
-    for uid, user_data in data.items():
-        if uid not in app['users']:
-            app['users'][uid] = {'color': user_data['color']}
+def merge_users(users, data):
+    for uid, user_data in (data or {}).items():
+        if not isinstance(user_data, dict) or 'color' not in user_data:
+            continue
+        users.setdefault(uid, {}).update({'color': user_data['color']})
+
+
+class FirebaseUsers(object):
+    # Keeps app['users'] colours in sync with firebase through one long-lived
+    # authorised session. The whole tree is refreshed periodically in the
+    # background, a miss only fetches that uid, concurrent misses for the same
+    # uid share one request and uids missing in firebase are remembered for a while.
+
+    def __init__(self, users, url, refresh_interval=300, negative_ttl=30):
+        self.users = users
+        self.url = url.rstrip('/')
+        self.refresh_interval = refresh_interval
+        self.negative_ttl = negative_ttl
+        self.session = None
+        self.inflight = {}
+        self.missing = {}
+        self.task = None
+
+    async def get_session(self):
+        if self.session is None:
+            self.session = await run_async(get_authed_session)
+
+        return self.session
+
+    async def fetch(self, path):
+        session = await self.get_session()
+
+        try:
+            res = await run_async(session.get, f'{self.url}/{path}.json')
+            res.raise_for_status()
+        except Exception as e:
+            logger.exception("Firebase request for %s failed", path)
+            raise ValueError(e)
+
+        return res.json()
+
+    def single_flight(self, key, path):
+        # Callers asking for the same path while a request is running share it
+        if key not in self.inflight:
+            future = asyncio.ensure_future(self.fetch(path))
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+            self.inflight[key] = future
+
+        return asyncio.shield(self.inflight[key])
+
+    async def update(self):
+        merge_users(self.users, await self.single_flight(None, ''))
+        self.missing.clear()
+
+    async def color(self, uid):
+        user = self.users.get(uid, {})
+        if 'color' in user:
+            return user['color']
+
+        checked = self.missing.get(uid)
+        if checked is not None and time.monotonic() - checked < self.negative_ttl:
+            return None
+
+        data = await self.single_flight(uid, uid)
+        if data:
+            merge_users(self.users, {uid: data})
         else:
-            app['users'][uid].update({'color': user_data['color']})
+            self.missing[uid] = time.monotonic()
+
+        return self.users.get(uid, {}).get('color')
+
+    async def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            try:
+                await self.update()
+                logger.info("Refreshed %s firebase users", len(self.users))
+            except Exception:
+                logger.exception("Firebase users refresh failed")
+
+            await asyncio.sleep(self.refresh_interval)
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+async def update_users(app):
+    await app['firebase'].update()
 
 
 async def get_token_payload(token, app):
-    payload = jwt.decode(token=token, certs=app['jwt_cers'], audience='theurbngame')
+    payload = app['token_cache'].get(token)
+
+    if payload is None:
+        payload = jwt.decode(token=token, certs=app['certs'].certs, audience='theurbngame')
+        app['token_cache'].put(token, payload)
 
     if not payload['user_id'] in app['users']:
         app['users'][payload['user_id']] = {'name': payload['name']}
@@ -65,12 +149,7 @@ async def get_token_payload(token, app):
 
 
 async def get_user_color(app, uid):
-    if uid in app['users'] and 'color' in app['users'][uid]:
-        return app['users'][uid]['color']
-
-    await update_users(app)
-
-    return app['users'].get(uid, {}).get('color')
+    return await app['firebase'].color(uid)
 
 
 async def get_user_name(app, uid):
@@ -1,10 +1,107 @@
+import atexit
 import logging
+import queue
+import sys
+import time
 from logging import getLogger
+from logging.handlers import QueueHandler, QueueListener
 
-logging.basicConfig(
-    format='[{asctime:15}] [{name}.{funcName}:{lineno}] {levelname:7} {message}',
-    style='{',
-    level=logging.DEBUG,
-)
+FORMAT = '[{asctime:15}] [{name}.{funcName}:{lineno}] {levelname:7} {message}'
 
-__all__ = ['getLogger']
+
+class DeferredQueueHandler(QueueHandler):
+    # Records are laid out and written by the listener thread. The message and
+    # traceback are rendered here first, as their arguments may change once the
+    # call returns and tracebacks would keep whole frames alive in the queue.
+    exceptions = logging.Formatter()
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = self.exceptions.formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+
+class SampledLogger(object):
+    # Lets through at most `rate` records per second for every message
+    # template and reports how many were skipped in between. Without an explicit
+    # rate the configured default is used, read on every record.
+
+    def __init__(self, logger, rate=None):
+        self.logger = logger
+        self.rate = rate
+        self.windows = {}
+
+    def allow(self, msg):
+        now = int(time.monotonic())
+        window, passed, skipped = self.windows.get(msg, (now, 0, 0))
+
+        if window != now:
+            window, passed = now, 0
+
+        if passed >= (_sample_rate if self.rate is None else self.rate):
+            self.windows[msg] = window, passed, skipped + 1
+            return None
+
+        self.windows[msg] = window, passed + 1, 0
+        return skipped
+
+    def log(self, level, msg, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+
+        skipped = self.allow(msg)
+        if skipped is None:
+            return
+
+        if skipped:
+            msg = f'{msg} ({skipped} similar skipped)'
+
+        # Attribute the record to the caller of debug()/info(), not to this wrapper
+        caller = sys._getframe(2)
+        self.logger.handle(self.logger.makeRecord(
+            self.logger.name, level, caller.f_code.co_filename, caller.f_lineno,
+            msg, args, None, caller.f_code.co_name))
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
+
+
+def sampled(logger, rate=None):
+    return SampledLogger(logger, rate)
+
+
+def configure(level=None, levels=None, sample_rate=None):
+    global _sample_rate
+
+    if level:
+        logging.getLogger().setLevel(level)
+
+    for name, logger_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    if sample_rate is not None:
+        _sample_rate = sample_rate
+
+
+_sample_rate = 10
+_queue = queue.Queue(-1)
+_stream = logging.StreamHandler()
+_stream.setFormatter(logging.Formatter(FORMAT, style='{'))
+_listener = QueueListener(_queue, _stream)
+
+logging.basicConfig(level=logging.DEBUG, handlers=[DeferredQueueHandler(_queue)])
+_listener.start()
+atexit.register(_listener.stop)
+
+__all__ = ['getLogger', 'sampled', 'configure']
@@ -1,21 +1,39 @@
 import asyncio
+from functools import partial
 
 import aiohttp_cors
 
-from aiohttp import web, ClientSession
+from aiohttp import web
+from bson import Timestamp
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo import ASCENDING
 
+from turg.auth import CertManager, TokenCache
+from turg.backplane import create_backplane
+from turg.broadcaster import Broadcaster
+from turg.compression import CompressionPolicy
 from turg.config import Config
-from turg.logger import getLogger
-from turg.ratelimiter import RateLimiter
+from turg.connections import Registry
+from turg.firebase import FirebaseUsers
+from turg.logger import configure, getLogger, sampled
+from turg.metrics import PING_SECONDS
+from turg.morton import INDEXES
+from turg.ranking import Ranking
+from turg.ratelimiter import RateLimiter, MongoRateLimiter
+from turg.snapshot import SnapshotWriter, load_latest
+from turg.subscriptions import Subscriptions
+from turg.tiles import TileCache
+from turg.world import World
+from turg.writer import BatchWriter
 from turg.views import (
     websocket,
     leaderboard,
+    metrics,
 )
 
 logger = getLogger(__name__)
+hot_logger = sampled(logger)
 config = Config()
+configure(config.log_level, config.log_levels, config.log_sample_rate)
 
 
 def create_app():
@@ -24,7 +42,7 @@ def create_app():
     # Configure default CORS settings.
     cors = aiohttp_cors.setup(app, )
 
-    for view in (websocket, leaderboard):
+    for view in (websocket, leaderboard, metrics):
         routes = view.factory(app)
         routes = routes if isinstance(routes, list) else [routes]
         for route in routes:
@@ -39,52 +57,130 @@ async def on_start(app):
     client = AsyncIOMotorClient(config.mongodb_uri)
     app['db_client'] = client
     app['db'] = client.get_default_database()  # defined in mongodb_uri
-    app['websockets'] = []
-    app['websockets_colors'] = {}
-    app['colors_websocket'] = {}
+    app['connections'] = Registry()
     app['users'] = {}
-    app['limiter'] = RateLimiter(config.rate_limit)
-
+    app['firebase'] = FirebaseUsers(app['users'], config.firebase_url,
+                                    config.firebase_refresh_interval, config.firebase_negative_ttl)
+    app['subscriptions'] = Subscriptions(config.aoi_cell_size)
+    app['broadcaster'] = Broadcaster(config.send_queue_size, config.slow_consumer_policy)
+    app['compression'] = CompressionPolicy(config.ws_compress_threshold, config.ws_compress_level,
+                                           config.ws_compress_wbits)
+
+    app['certs'] = CertManager(config.jwt_certs_url, config.jwt_refresh_min,
+                               config.jwt_refresh_max, config.jwt_retry_interval)
+    app['token_cache'] = TokenCache(config.jwt_cache_size)
     try:
-        async with ClientSession() as session:
-            async with session.get(config.jwt_certs_url) as res:
-                app['jwt_cers'] = await res.json()
-                logger.info("Load jwt certs: %s", app['jwt_cers'])
+        await app['certs'].start()
     except:
         logger.error('Get jwt certs error')
         raise
 
-    await app['db'].data.create_index([('x', ASCENDING), ('y', ASCENDING)])
+    await check_indexes(app['db'])
+
+    if config.rate_limit_store == 'mongo':
+        app['limiter'] = MongoRateLimiter(app['db'].ratelimits, config.rate_limit,
+                                          config.rate_limit_burst, config.rate_limit_costs,
+                                          sync_interval=config.rate_limit_sync_interval)
+        await app['limiter'].start()
+    else:
+        app['limiter'] = RateLimiter(config.rate_limit, config.rate_limit_burst,
+                                     config.rate_limit_costs)
+
+    app['world'] = await load_world(app['db'])
+    app['tiles'] = TileCache(app['world'], config.tile_size, config.tile_cache_bytes)
+    app['ranking'] = Ranking()
+    await app['ranking'].load(app['db'], app['world'])
+    app['writer'] = BatchWriter(app['db'], config.write_batch_size, config.write_flush_interval)
+    app['leaderboard_feed'] = leaderboard.LeaderboardFeed(app, config.leaderboard_push_interval)
+
+    app['backplane'] = create_backplane(config.backplane, app['db'],
+                                        config.backplane_collection, config.backplane_size)
+    app['backplane'].subscribe(partial(websocket.handle_event, app))
+    await app['backplane'].start()
+
+    await app['firebase'].start()
+
+    app['snapshots'] = None
+    if config.snapshot_dir:
+        app['snapshots'] = SnapshotWriter(app['world'], config.snapshot_dir,
+                                          config.snapshot_interval, config.snapshot_keep,
+                                          app['db'], app['writer'])
+        await app['snapshots'].start()
 
     asyncio.ensure_future(ping(app))
 
 
+async def check_indexes(db):
+    # Building indexes blocks a live collection and the key index needs its
+    # backfill first, both are left to turg.migrate which builds them in the background
+    existing = await db.data.index_information()
+
+    for keys, options in INDEXES:
+        name = '_'.join(f'{field}_{direction}' for field, direction in keys)
+        if name not in existing:
+            logger.warning("Index %s is missing, run python -m turg.migrate", name)
+
+
+async def load_world(db):
+    # The latest snapshot plus what mongo stamped since it was taken, both by
+    # mongo's clock. The margin covers updates of other workers that had not
+    # reached the snapshot's worker yet, replaying a document twice is harmless.
+    world, taken = None, None
+    if config.snapshot_dir:
+        world, taken = load_latest(config.snapshot_dir, config.chunk_size)
+
+    if world is None:
+        world = World(config.chunk_size)
+        await world.load(db)
+    else:
+        await world.load(db, Timestamp(max(int(taken - config.snapshot_replay_margin), 0), 0))
+        logger.info("World has %s voxels after replay, world version %s",
+                    world.count, world.version)
+
+    return world
+
+
 async def ping(app):
     while True:
         await asyncio.sleep(config.ping_interval)
         closed_ws = []
 
-        for ws in app['websockets']:
-            try:
-                logger.info("Ping ws %s", id(ws))
+        logger.info("Broadcast stats: %s", app['broadcaster'].report())
+        logger.info("Connections: %s, registry memory %s bytes",
+                    app['connections'].counts(), app['connections'].memory())
+        logger.info("Evicted %s idle rate limit buckets", app['limiter'].evict())
+
+        with PING_SECONDS.time():
+            for ws in app['connections'].sockets():
+                try:
+                    hot_logger.debug("Ping ws %s", id(ws))
 
-                ws.ping()
-            except:
-                logger.exception("Client ping failed")
-                logger.info("Close ws %s", id(ws))
+                    ws.ping()
+                except:
+                    logger.exception("Client ping failed")
+                    logger.info("Close ws %s", id(ws))
 
-                await ws.close()
-                closed_ws.append(ws)
+                    await ws.close()
+                    closed_ws.append(ws)
 
-        for ws in closed_ws:
-            if ws in app['websockets']:
-                app['websockets'].remove(ws)
+            for ws in closed_ws:
+                websocket.forget_connection(ws, app)
 
 
 async def on_shutdown(app):
+    app['certs'].stop()
+    app['firebase'].stop()
+    await app['backplane'].stop()
+    await app['writer'].close()
+    if config.rate_limit_store == 'mongo':
+        await app['limiter'].stop()
+    if app['snapshots'] is not None:
+        await app['snapshots'].stop()
     app['db_client'].close()
+    app['broadcaster'].close()
+    app['leaderboard_feed'].close()
 
-    for ws in app['websockets']:
+    for ws in app['connections'].sockets():
         await ws.close()
 
 
@@ -0,0 +1,170 @@
+import functools
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Prometheus style metrics kept in process and rendered in the text
+# exposition format by the /v1/metrics view.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000)
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_labels(key):
+    if not key:
+        return ''
+
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in key) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, function=None):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        self.function = function
+
+    def set_function(self, function):
+        # function returns a number or a {label tuple: value} mapping,
+        # it is called on every scrape instead of reading stored values
+        self.function = function
+
+    def samples(self):
+        values = self.values
+        if self.function is not None:
+            result = self.function()
+            values = result if isinstance(result, dict) else {(): result}
+
+        for key, value in values.items():
+            yield self.name, key, value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(f'{name}{format_labels(key)} {format_value(value)}'
+                     for name, key, value in self.samples())
+
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = label_key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[label_key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        series = self.values.get(key)
+
+        if series is None:
+            series = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield (f'{self.name}_bucket',
+                       key + (('le', format_value(bound)),), cumulative)
+            yield f'{self.name}_sum', key, total
+            yield f'{self.name}_count', key, count
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, function=None):
+        return self.register(Counter(name, documentation, function))
+
+    def gauge(self, name, documentation, function=None):
+        return self.register(Gauge(name, documentation, function))
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, buckets))
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    'turg_ws_request_seconds', 'Websocket request handling time by message type')
+RATE_LIMITED = REGISTRY.counter(
+    'turg_ws_rate_limited_total', 'Websocket messages rejected by the rate limiter')
+STORE_VOXEL_SECONDS = REGISTRY.histogram(
+    'turg_store_voxel_seconds', 'Voxel placement time including the durable write')
+GET_VOXELS_SECONDS = REGISTRY.histogram(
+    'turg_get_voxels_seconds', 'Range read time')
+RANGE_VOXELS = REGISTRY.histogram(
+    'turg_range_voxels', 'Voxels returned per range read', SIZE_BUCKETS)
+BROADCAST_SECONDS = REGISTRY.histogram(
+    'turg_broadcast_seconds', 'Broadcast fan-out time')
+BROADCAST_RECIPIENTS = REGISTRY.histogram(
+    'turg_broadcast_recipients', 'Sockets per broadcast', SIZE_BUCKETS)
+PING_SECONDS = REGISTRY.histogram(
+    'turg_ping_seconds', 'Duration of one ping round over every socket')
+MONGO_SECONDS = REGISTRY.histogram(
+    'turg_mongo_seconds', 'MongoDB operation time by operation')
+
+
+def timed(histogram, **labels):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
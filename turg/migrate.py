@@ -0,0 +1,130 @@
+import argparse
+import random
+
+from pymongo import DESCENDING, MongoClient, UpdateOne
+from pymongo.errors import OperationFailure
+
+from turg.config import Config
+from turg.logger import getLogger
+from turg.morton import INDEXES, box_query, chunk_key
+
+logger = getLogger(__name__)
+config = Config()
+
+# Brings an existing voxel collection up to date while the server runs:
+# backfills Morton chunk keys, removes duplicate voxels left by repeated
+# imports and creates the indexes, then optionally checks key queries.
+#
+#   python -m turg.migrate [--batch-size 1000] [--rekey] [--verify 100]
+
+LEGACY_INDEXES = ('x_1_y_1', 'updated_1')
+
+
+def backfill(collection, chunk_size, batch_size, rekey=False):
+    query = {} if rekey else {'key': {'$exists': False}}
+    total = collection.count(query)
+    done = 0
+    batch = []
+
+    logger.info("Backfilling keys of %s voxels", total)
+    for doc in collection.find(query, projection={'x': True, 'y': True, 'z': True}):
+        batch.append(UpdateOne({'_id': doc['_id']}, {
+            '$set': {'key': chunk_key(doc['x'], doc['y'], doc['z'], chunk_size)},
+        }))
+
+        if len(batch) >= batch_size:
+            collection.bulk_write(batch, ordered=False)
+            done += len(batch)
+            batch = []
+            logger.info("%s/%s voxels", done, total)
+
+    if batch:
+        collection.bulk_write(batch, ordered=False)
+        done += len(batch)
+
+    logger.info("Backfilled %s keys", done)
+
+
+def deduplicate(collection):
+    # Keeps the newest document of every position by the server's write stamp,
+    # then by `updated` for documents written before stamps. Versions are per
+    # worker and per run, they say nothing about which document is newer.
+    duplicates = collection.aggregate([
+        {'$group': {'_id': {'x': '$x', 'y': '$y', 'z': '$z'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+    ], allowDiskUse=True)
+    removed = 0
+
+    for duplicate in duplicates:
+        docs = collection.find(duplicate['_id'], projection={'_id': True}).sort(
+            [('stamp', DESCENDING), ('updated', DESCENDING)])
+        stale = [doc['_id'] for doc in docs][1:]
+        removed += collection.delete_many({'_id': {'$in': stale}}).deleted_count
+
+    logger.info("Removed %s duplicate voxels", removed)
+
+
+def create_indexes(collection):
+    for keys, options in INDEXES:
+        logger.info("Create index %s", keys)
+        collection.create_index(keys, background=True, **options)
+
+    existing = collection.index_information()
+    for name in LEGACY_INDEXES:
+        if name in existing:
+            logger.info("Drop index %s", name)
+            collection.drop_index(name)
+
+
+def verify(collection, chunk_size, boxes, size=64):
+    # Key interval queries must find exactly what plain coordinate queries find
+    bounds = collection.find_one(sort=[('x', DESCENDING)]), collection.find_one(
+        sort=[('y', DESCENDING)])
+    if not all(bounds):
+        logger.info("No voxels to verify")
+        return True
+
+    max_x, max_y = bounds[0]['x'], bounds[1]['y']
+    for _ in range(boxes):
+        x, y = random.randint(0, max_x), random.randint(0, max_y)
+        box = x, x + size, y, y + size, 0, config.max_z
+        keyed = collection.count(box_query(*box, chunk_size))
+        plain = collection.count({'x': {'$gte': box[0], '$lte': box[1]},
+                                  'y': {'$gte': box[2], '$lte': box[3]}})
+
+        if keyed != plain:
+            logger.error("Box %s: %s voxels by key, %s by coordinates", box, keyed, plain)
+            return False
+
+    logger.info("Verified %s boxes", boxes)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m turg.migrate')
+    parser.add_argument("--batch-size", help="documents per write", default=1000, type=int)
+    parser.add_argument("--rekey", help="recompute every key, after changing chunk_size",
+                        action='store_true')
+    parser.add_argument("--verify", help="random boxes to check afterwards", default=0, type=int)
+    args = parser.parse_args()
+
+    client = MongoClient(config.mongodb_uri)
+    collection = client.get_default_database().data
+
+    backfill(collection, config.chunk_size, args.batch_size, args.rekey)
+    deduplicate(collection)
+    try:
+        create_indexes(collection)
+    except OperationFailure:
+        # Voxels placed while deduplicating, running the command again finishes the job
+        logger.exception("Creating indexes failed")
+        raise SystemExit(1)
+
+    if args.verify and not verify(collection, config.chunk_size, args.verify):
+        raise SystemExit(1)
+
+    client.close()
+
+
+if __name__ == '__main__':
+    main()
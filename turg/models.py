@@ -1,13 +1,27 @@
 import attr
-from collections import defaultdict
 from datetime import datetime
 
+from pymongo import UpdateOne
+
+from turg import rules
 from turg.config import Config
 from turg.logger import getLogger
+from turg.metrics import timed, GET_VOXELS_SECONDS, RANGE_VOXELS, STORE_VOXEL_SECONDS
+from turg.morton import STAMP, chunk_key
+from turg.writer import WriteFailed
 
 config = Config()
 logger = getLogger()
 
+RULE_MESSAGES = {
+    rules.TOO_FAR: "You must have at least one voxel no farther than 5 spaces from flag",
+    rules.OCCUPIED: "Space already occupied",
+    rules.TOO_CLOSE: "Too close to other player's voxels",
+    rules.UNSUPPORTED: "Voxel can be placed at ground level or adjacent to your other voxels",
+    rules.NEAR_FLAG: "Voxels cannot be placed next to a flag",
+}
+SAVE_FAILED = "Voxel could not be saved, try again"
+
 
 @attr.s
 class Voxel(object):
@@ -21,19 +35,62 @@ class Voxel(object):
     owner = attr.ib()
     name = attr.ib(default=None)
     updated = attr.ib(default=None)
+    version = attr.ib(default=None)
 
 
-async def get_voxels(x, y, range, db):
-    results = db.data.find({'x': {'$gt': x - range, '$lt': x + range},
-                            'y': {'$gt': y - range, '$lt': y + range}},
-                           projection={'_id': False, 'updated': False})
-    data = []
-    async for result in results:
-        if not result.get('name'):
-            result.pop('name', None)
-        data.append(result)
+@timed(GET_VOXELS_SECONDS)
+async def get_voxels(x, y, range, app, since=None):
+    voxels = app['world'].area(x, y, range, since)
+    RANGE_VOXELS.observe(len(voxels))
 
-    return data
+    return voxels
+
+
+@timed(GET_VOXELS_SECONDS)
+async def get_voxels_json(x, y, range, app):
+    # Full area as comma separated JSON voxels from the tile cache
+    voxels, count = app['tiles'].area(x, y, range)
+    RANGE_VOXELS.observe(count)
+
+    return voxels
+
+
+def paginate(pieces, page_size):
+    # Regroups lists of voxels into (page, end) with page_size voxels per
+    # page, there is always a last page flagged as the end, maybe empty
+    page, full = [], None
+
+    for piece in pieces:
+        start = 0
+        while start < len(piece):
+            if full is not None:
+                yield full, False
+                full = None
+
+            take = page_size - len(page)
+            page.extend(piece[start:start + take])
+            start += take
+
+            if len(page) == page_size:
+                full, page = page, []
+
+    if full is not None:
+        yield full, not page
+    if page or full is None:
+        yield page, True
+
+
+def voxel_pages(x, y, range, app, since=None, encoded=False, page_size=None):
+    # Pages of get_voxels, or with encoded=True of the JSON voxels of
+    # get_voxels_json. The area is read a column or tile at a time as pages
+    # are taken, so a reply never holds more than a page and one piece.
+    if encoded:
+        pieces = app['tiles'].pieces(x, y, range)
+    else:
+        world = app['world']
+        pieces = world.rect_columns(*world.bounds(x, y, range), since=since)
+
+    return paginate(pieces, page_size or config.range_page_size)
 
 
 def verify_payload(payload):
@@ -46,82 +103,48 @@ def verify_payload(payload):
     return True
 
 
+@timed(STORE_VOXEL_SECONDS)
 async def store_voxel(voxel: Voxel, app):
-    db = app['db']
-    neighbours = await get_neighbours(db, voxel, 5)
-
-    occupied = space_occupied(voxel, neighbours)
-    flag = occupied if occupied.get('name') else None
-
-    if flag and flag.get('owner') != voxel.owner:
-        if too_far_from_flag(voxel, neighbours, flag):
-            data = response_cleanup(flag)
-            raise ValueError(
-                {"message": "You must have at least one voxel no farther than 5 spaces from flag",
-                 "conflict": data})
-        return await capture_flag(voxel, flag, app)
-
-    if occupied:
-        data = response_cleanup(occupied)
-        raise ValueError({"message": "Space already occupied",
-                          "conflict": data})
-
-    near_neighbours = immediate_neighbours(voxel, neighbours)
-
-    conflict = too_close(voxel, near_neighbours)
-    if conflict:
-        data = response_cleanup(conflict)
-        raise ValueError({"message": "Too close to other player's voxels",
-                          "conflict": data})
-
-    valid = valid_location(voxel, near_neighbours)
-    if not valid:
-        data = response_cleanup(attr.asdict(voxel))
-        raise ValueError({"message": "Voxel can be placed at ground level "
-                                     "or adjacent to your other voxels",
-                          "conflict": data})
-
-    near_flag = too_close_to_flag(voxel, neighbours)
-    if near_flag:
-        data = response_cleanup(near_flag)
-        raise ValueError({"message": "Voxels cannot be placed next to a flag",
-                          "conflict": data})
-
-    await db.data.insert_one(attr.asdict(voxel))
-    return voxel
-
-
-async def get_neighbours(db, voxel, range):
-    cube_volume = (2 * range + 1) ** 3
-    return await db.data.find({'x': {'$lte': voxel.x + range, '$gte': voxel.x - range},
-                               'y': {'$lte': voxel.y + range, '$gte': voxel.y - range},
-                               'z': {'$lte': voxel.z + range, '$gte': voxel.z - range}},
-                              projection={'_id': False}).to_list(cube_volume)
-
-
-def space_occupied(voxel, neighbours):
-    curr_voxel = [n for n in neighbours if n['x'] == voxel.x
-                  and n['y'] == voxel.y and n['z'] == voxel.z]
-    return curr_voxel[0] if curr_voxel else {}
-
-
-def valid_location(voxel, adjacent):
-    return [n for n in adjacent if
-            n['y'] == voxel.y and n['z'] == voxel.z or
-            n['y'] == voxel.y and n['x'] == voxel.x or
-            n['z'] == voxel.z and n['x'] == voxel.x] \
-           or voxel.z == 0
+    # Validation and the in-memory update must not yield to the event loop,
+    # that keeps concurrent placements of this worker serialised against a
+    # consistent world. Other workers' placements are not, see the README.
+    rule, conflict = rules.check(app['world'], voxel.x, voxel.y, voxel.z, voxel.owner)
+
+    if rule == rules.CAPTURE:
+        return await capture_flag(voxel, conflict, app)
+
+    if rule != rules.OK:
+        if rule == rules.UNSUPPORTED:
+            conflict = attr.asdict(voxel)
+        raise ValueError({"message": RULE_MESSAGES[rule],
+                          "conflict": response_cleanup(conflict)})
+
+    voxel.version = app['world'].set(voxel.x, voxel.y, voxel.z, voxel.owner,
+                                     voxel.name, voxel.updated)
+    app['tiles'].invalidate(voxel.x, voxel.y)
+    doc = attr.asdict(voxel)
+    doc['key'] = chunk_key(voxel.x, voxel.y, voxel.z, config.chunk_size)
+    # Only replaces an older voxel: when another worker placed a newer one at
+    # the same spot the upsert hits the unique index and this placement fails
+    older = {'x': voxel.x, 'y': voxel.y, 'z': voxel.z, 'updated': {'$lte': voxel.updated}}
+    try:
+        await app['writer'].submit('data', UpdateOne(older, {'$set': doc, '$currentDate': STAMP},
+                                                     upsert=True))
+    except WriteFailed:
+        # Nothing was broadcast yet, forgetting the voxel brings memory back in line with
+        # mongo, unless a newer one from another worker has replaced it meanwhile
+        if owns_position(app['world'], voxel):
+            app['world'].remove(voxel.x, voxel.y, voxel.z)
+            app['tiles'].invalidate(voxel.x, voxel.y)
+        raise ValueError({"message": SAVE_FAILED})
 
+    return voxel
 
-def immediate_neighbours(voxel, neighbours):
-    return [n for n in neighbours if
-            n.get('x') <= voxel.x + 1 and n.get('x') >= voxel.x - 1
-            and n.get('y') <= voxel.y + 1 and n.get('y') >= voxel.y - 1
-            and n.get('z') <= voxel.z + 1 and n.get('z') >= voxel.z - 1]
 
+def owns_position(world, voxel):
+    current = world.get(voxel.x, voxel.y, voxel.z)
 
-def too_close(voxel, adjacent):
-    return [n for n in adjacent if n['owner'] != voxel.owner]
+    return current is not None and current['version'] == voxel.version
 
 
 def response_cleanup(data):
@@ -129,46 +152,61 @@ def response_cleanup(data):
         for item in data:
             item.pop('name', None)
             item.pop('updated', None)
+            item.pop('version', None)
     else:
         data.pop('name', None)
         data.pop('updated', None)
+        data.pop('version', None)
 
     return data
 
 
 async def capture_flag(new_voxel, curr_voxel, app):
-    db = app['db']
+    writer = app['writer']
+    ranking = app['ranking']
+    flag = (new_voxel.x, new_voxel.y, new_voxel.z)
+    position = {'x': new_voxel.x, 'y': new_voxel.y, 'z': new_voxel.z}
 
     if curr_voxel.get('updated'):
         ownership_time = (new_voxel.updated - curr_voxel.get('updated')).total_seconds()
     else:
         ownership_time = 0
 
-    await db.data.update_one({'x': new_voxel.x, 'y': new_voxel.y, 'z': new_voxel.z},
-                             {'$set': {'owner': new_voxel.owner, 'updated': new_voxel.updated}})
+    previous = ranking.flags.get(flag)
+    new_voxel.version = app['world'].set(new_voxel.x, new_voxel.y, new_voxel.z,
+                                         new_voxel.owner, curr_voxel['name'], new_voxel.updated)
+    app['tiles'].invalidate(new_voxel.x, new_voxel.y)
+    ranking.capture(flag, new_voxel.owner, new_voxel.updated)
+
+    # The leaderboard is only credited once the capture itself is stored
+    try:
+        await writer.submit('data', UpdateOne(position, {'$set': {'owner': new_voxel.owner,
+                                                                  'updated': new_voxel.updated,
+                                                                  'version': new_voxel.version},
+                                                         '$currentDate': STAMP}))
+    except WriteFailed:
+        if owns_position(app['world'], new_voxel):
+            app['world'].set(new_voxel.x, new_voxel.y, new_voxel.z, curr_voxel['owner'],
+                             curr_voxel['name'], curr_voxel.get('updated'))
+            app['tiles'].invalidate(new_voxel.x, new_voxel.y)
+            ranking.revert(flag, previous, new_voxel.updated)
+        raise ValueError({"message": SAVE_FAILED})
+
+    try:
+        await writer.submit('leaderboard', UpdateOne({'owner': curr_voxel['owner']},
+                                                     {'$inc': {'time': ownership_time}},
+                                                     upsert=True))
+    except WriteFailed:
+        # The capture stands, only the time is lost, in memory as in mongo
+        logger.error("Lost %.0fs of flag time of %s", ownership_time, curr_voxel['owner'])
+        if previous is not None and previous[1] is not None:
+            ranking.bank(curr_voxel['owner'], -ownership_time)
 
-    await db.leaderboard.update_one({'owner': curr_voxel['owner']},
-                                    {'$inc': {'time': ownership_time}},
-                                    upsert=True)
     new_voxel.name = curr_voxel['name']
     new_voxel.captured = True
     return new_voxel
 
 
-def too_close_to_flag(voxel, neighbours):
-    flags = [n for n in neighbours if n.get('name')]
-    for flag in flags:
-        if all([abs(coord) <= 4 for coord in [(voxel.x - flag.get('x')),
-                                              (voxel.y - flag.get('y')),
-                                              (voxel.z - flag.get('z'))]]):
-            return flag
-    return None
-
-
-def too_far_from_flag(voxel, neighbours, flag):
-    return all([n.get('owner') != voxel.owner for n in neighbours])
-
-
 def get_owner_names(users):
     names = {}
     for uid, user in users.items():
@@ -177,21 +215,8 @@ def get_owner_names(users):
     return names
 
 
-async def get_leaders(app):
-    db = app['db']
+async def get_leaders(app, limit=None):
     names = get_owner_names(app['users'])
-    leaderboard = defaultdict(float)
-    curr_time = datetime.utcnow()
-
-    leaders = db.leaderboard.find({'owner': {'$ne': '#ff00ff'}}, projection={'_id': False})
-
-    async for leader in leaders:
-        leaderboard[leader['owner']] = leader['time']
-
-    results = db.data.find({'name': {'$ne': None}}, projection={'_id': False})
-    async for result in results:
-        if result.get('updated') and result.get('owner') != '#ff00ff':
-            leaderboard[result['owner']] += (curr_time - result['updated']).total_seconds()
 
-    return [{'owner': k, 'name': names.get(k, k), 'time': leaderboard[k]} for k in
-            sorted(leaderboard, key=leaderboard.get, reverse=True)]
+    return [{'owner': owner, 'name': names.get(owner, owner), 'time': time}
+            for owner, time in app['ranking'].top(limit)]
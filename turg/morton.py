@@ -0,0 +1,92 @@
+from pymongo import ASCENDING
+
+# Z-order (Morton) keys of world chunks. Every voxel document carries the key
+# of its chunk, so a box query becomes a few scans over key intervals of the
+# ('key', x, y, z) index instead of a scan over x filtered document by document.
+
+BITS = 21  # per axis, keys fit in a signed 64 bit integer
+
+INDEXES = [
+    ([('x', ASCENDING), ('y', ASCENDING), ('z', ASCENDING)], {'unique': True}),
+    ([('key', ASCENDING), ('x', ASCENDING), ('y', ASCENDING), ('z', ASCENDING)], {}),
+    ([('stamp', ASCENDING)], {}),
+]
+
+# Every voxel write sets `stamp` by the server's clock, snapshots are replayed
+# from it. Unlike `updated` it never depends on the clock of the writing node.
+STAMP = {'stamp': {'$type': 'timestamp'}}
+
+
+def spread(value):
+    # Inserts two zero bits between the bits of a 21 bit value
+    value &= 0x1fffff
+    value = (value | value << 32) & 0x1f00000000ffff
+    value = (value | value << 16) & 0x1f0000ff0000ff
+    value = (value | value << 8) & 0x100f00f00f00f00f
+    value = (value | value << 4) & 0x10c30c30c30c30c3
+    value = (value | value << 2) & 0x1249249249249249
+
+    return value
+
+
+def encode(cx, cy, cz):
+    return spread(cx) | spread(cy) << 1 | spread(cz) << 2
+
+
+def chunk_key(x, y, z, chunk_size):
+    return encode(x // chunk_size, y // chunk_size, z // chunk_size)
+
+
+def intervals(low, high, max_intervals=16):
+    # Inclusive key intervals covering the inclusive chunk box low..high,
+    # found by descending the implicit octree of the key space. When there are
+    # more than max_intervals the smallest gaps are merged, which only adds
+    # chunks the x/y/z conditions filter out.
+    found = []
+
+    def descend(origin, level):
+        side = 1 << level
+        corner = [o + side - 1 for o in origin]
+
+        if any(c < lo or o > hi for o, c, lo, hi in zip(origin, corner, low, high)):
+            return
+
+        if all(lo <= o and c <= hi for o, c, lo, hi in zip(origin, corner, low, high)):
+            start = encode(*origin)
+            found.append([start, start + side ** 3 - 1])
+            return
+
+        half = side >> 1
+        for i in range(8):
+            descend([o + half * (i >> axis & 1) for axis, o in enumerate(origin)], level - 1)
+
+    level = max(max(high).bit_length(), 1)
+    descend([0, 0, 0], level)
+
+    merged = []
+    for start, end in found:
+        if merged and start == merged[-1][1] + 1:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end])
+
+    while len(merged) > max_intervals:
+        gap = min(range(len(merged) - 1), key=lambda i: merged[i + 1][0] - merged[i][1])
+        merged[gap][1] = merged.pop(gap + 1)[1]
+
+    return [tuple(interval) for interval in merged]
+
+
+def box_query(x_min, x_max, y_min, y_max, z_min, z_max, chunk_size, max_intervals=16):
+    # Mongo filter for the voxels of an inclusive box
+    low = [max(v, 0) // chunk_size for v in (x_min, y_min, z_min)]
+    high = [v // chunk_size for v in (x_max, y_max, z_max)]
+    keys = [{'key': {'$gte': start, '$lte': end}}
+            for start, end in intervals(low, high, max_intervals)]
+
+    return {
+        '$or': keys or [{'key': -1}],
+        'x': {'$gte': x_min, '$lte': x_max},
+        'y': {'$gte': y_min, '$lte': y_max},
+        'z': {'$gte': z_min, '$lte': z_max},
+    }
@@ -0,0 +1,137 @@
+import heapq
+from datetime import datetime
+from itertools import islice
+
+from sortedcontainers import SortedList
+
+from turg.logger import getLogger
+from turg.world import to_timestamp
+
+logger = getLogger(__name__)
+
+SPOT_FLAG_COLOR = '#ff00ff'
+
+
+class Ranking(object):
+    # Leaderboard of flag holding time, kept up to date on every capture.
+    #
+    # An owner holding k flags scores banked + k * now - sum(since), so owners
+    # holding the same number of flags never change order as time passes. They
+    # are kept in one SortedList per k, ordered by banked - sum(since), so an
+    # update is O(log n), and the top of the board is a lazy merge of their heads.
+
+    def __init__(self, excluded=(SPOT_FLAG_COLOR,)):
+        self.excluded = set(excluded)
+        self.banked = {}
+        self.holding = {}
+        self.flags = {}
+        self.groups = {}
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def unlink(self, owner):
+        entry = self.entries.pop(owner, None)
+
+        if entry is None:
+            return
+
+        k, key = entry
+        group = self.groups[k]
+        group.remove(key)
+
+        if not group:
+            del self.groups[k]
+
+    def link(self, owner):
+        flags = self.holding.get(owner, {})
+        key = (-(self.banked.get(owner, 0.0) - sum(flags.values())), owner)
+        self.entries[owner] = len(flags), key
+        group = self.groups.get(len(flags))
+        if group is None:
+            group = self.groups[len(flags)] = SortedList()
+        group.add(key)
+
+    def bank(self, owner, seconds):
+        if owner in self.excluded:
+            return
+
+        self.unlink(owner)
+        self.banked[owner] = self.banked.get(owner, 0.0) + seconds
+        self.link(owner)
+
+    def hold(self, flag, owner, since):
+        self.flags[flag] = owner, since
+
+        if owner in self.excluded or since is None:
+            return
+
+        self.unlink(owner)
+        self.holding.setdefault(owner, {})[flag] = since
+        self.link(owner)
+
+    def release(self, flag, until=None):
+        # Without `until` the holder gets no time for it
+        owner, since = self.flags.pop(flag, (None, None))
+
+        if owner is None or flag not in self.holding.get(owner, {}):
+            return
+
+        self.unlink(owner)
+        del self.holding[owner][flag]
+        if not self.holding[owner]:
+            del self.holding[owner]
+        if until is not None:
+            self.banked[owner] = self.banked.get(owner, 0.0) + until - since
+        self.link(owner)
+
+    def capture(self, flag, owner, when):
+        when = to_timestamp(when)
+        self.release(flag, when)
+        self.hold(flag, owner, when)
+
+    def revert(self, flag, previous, when):
+        # Undoes capture(flag, owner, when), `previous` is what flags held before it
+        holder = self.flags.get(flag, (None, None))[0]
+        self.release(flag)
+        if holder is not None and holder not in self.holding and not self.banked.get(holder):
+            self.unlink(holder)
+
+        if previous is None:
+            return
+
+        owner, since = previous
+        if since is not None:
+            self.bank(owner, since - to_timestamp(when))
+        self.hold(flag, owner, since)
+
+    def leaders(self, now=None):
+        # Yields (owner, seconds) best first
+        now = to_timestamp(now or datetime.utcnow())
+
+        def scored(k, group):
+            for key, owner in group:
+                yield -key + k * now, owner
+
+        merged = heapq.merge(*(scored(k, group) for k, group in self.groups.items()),
+                             key=lambda item: -item[0])
+
+        for score, owner in merged:
+            yield owner, score
+
+    def top(self, n=None, now=None):
+        leaders = self.leaders(now)
+
+        return list(leaders if n is None else islice(leaders, n))
+
+    async def load(self, db, world):
+        async for leader in db.leaderboard.find({}, projection={'_id': False}):
+            self.bank(leader['owner'], leader.get('time', 0.0))
+
+        for flag in world.flags():
+            self.hold((flag['x'], flag['y'], flag['z']), flag['owner'],
+                      to_timestamp(flag['updated']) if flag['updated'] else None)
+
+        logger.info("Loaded leaderboard with %s owners and %s flags",
+                    len(self.entries), len(self.flags))
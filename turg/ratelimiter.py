@@ -1,25 +1,147 @@
-from datetime import datetime
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from pymongo.errors import DuplicateKeyError
+
+from turg.logger import getLogger
+
+logger = getLogger(__name__)
 
 
 class RateLimiter(object):
-    requests = None  # max requests per minute
+    # Token bucket per user: up to `burst` tokens, refilled at `requests`
+    # tokens per minute, every message costs `costs[type]` tokens (default 1).
+    requests = None  # tokens refilled per minute
+    burst = None
+    costs = None
     cache = None
 
-    def __init__(self, requests):
+    def __init__(self, requests, burst=None, costs=None, clock=time.monotonic):
         self.requests = requests
+        self.rate = requests / 60.0
+        self.burst = burst or requests
+        self.costs = costs or {}
+        self.clock = clock
         self.cache = {}
 
-    def limit_exceeded(self, user):
-        key = datetime.now().minute
-        if user not in self.cache:
-            self.cache[user] = {}
-        try:
-            if self.cache[user][key] >= self.requests:
-                return True
-            else:
-                self.cache[user][key] += 1
-        except KeyError:
-            self.cache[user].clear()
-            self.cache[user][key] = 1
+    def cost(self, kind):
+        return self.costs.get(kind, 1)
+
+    def refill(self, tokens, ts, now):
+        return min(self.burst, tokens + (now - ts) * self.rate)
+
+    async def limit_exceeded(self, user, kind=None):
+        now = self.clock()
+        cost = self.cost(kind)
+        tokens, ts = self.cache.get(user, (self.burst, now))
+        tokens = self.refill(tokens, ts, now)
+
+        if tokens < cost:
+            self.cache[user] = tokens, now
+            return True
 
+        self.cache[user] = tokens - cost, now
         return False
+
+    def evict(self):
+        # A bucket idle long enough to be full again is the same as no bucket
+        now = self.clock()
+        idle = self.burst / self.rate
+        stale = [user for user, (_, ts) in self.cache.items() if now - ts >= idle]
+
+        for user in stale:
+            del self.cache[user]
+
+        return len(stale)
+
+
+class MongoRateLimiter(RateLimiter):
+    # Buckets shared by every worker. Messages are checked against this
+    # worker's buckets, without a mongo round trip, and every `sync_interval`
+    # seconds the tokens spent meanwhile are taken from the shared bucket in a
+    # mongo collection with compare-and-swap. The shared bucket then replaces
+    # the local one, so other workers' messages count within an interval.
+    # Wall clock time is used since monotonic clocks are not comparable between
+    # processes. Idle buckets expire through a TTL index.
+
+    def __init__(self, collection, requests, burst=None, costs=None, retries=3,
+                 sync_interval=1.0):
+        super().__init__(requests, burst, costs, clock=time.time)
+        self.collection = collection
+        self.retries = retries
+        self.sync_interval = sync_interval
+        self.spent = {}
+        self.task = None
+
+    async def start(self):
+        await self.collection.create_index('expires', expireAfterSeconds=0)
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+        await self.sync()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+            except Exception:
+                logger.exception("Syncing rate limit buckets failed")
+
+    async def limit_exceeded(self, user, kind=None):
+        exceeded = await super().limit_exceeded(user, kind)
+
+        # Every user seen gets synced, the shared bucket may be emptier than this one
+        self.spent[user] = self.spent.get(user, 0) + (0 if exceeded else self.cost(kind))
+        return exceeded
+
+    async def sync(self):
+        spent, self.spent = self.spent, {}
+        users = list(spent)
+        buckets = await asyncio.gather(*(self.take(user, spent[user]) for user in users),
+                                       return_exceptions=True)
+
+        for user, bucket in zip(users, buckets):
+            if isinstance(bucket, Exception):
+                logger.warning("Rate limit bucket of %s not synced: %s", user, bucket)
+            elif bucket is not None:
+                # Less what this worker let through while mongo was asked
+                tokens, now = bucket
+                self.cache[user] = tokens - self.spent.get(user, 0), now
+
+    async def take(self, user, cost):
+        # Takes `cost` tokens from the shared bucket, returns (tokens left, time)
+        for _ in range(self.retries):
+            now = self.clock()
+            doc = await self.collection.find_one({'_id': user})
+
+            if doc is None:
+                tokens = self.burst - cost
+            else:
+                tokens = self.refill(doc['tokens'], doc['ts'], now) - cost
+
+            update = {
+                'tokens': tokens,
+                'ts': now,
+                'expires': datetime.utcnow() + timedelta(seconds=self.burst / self.rate),
+            }
+
+            if doc is None:
+                try:
+                    await self.collection.insert_one(dict(update, _id=user))
+                except DuplicateKeyError:
+                    continue
+                return tokens, now
+
+            result = await self.collection.update_one(
+                {'_id': user, 'ts': doc['ts'], 'tokens': doc['tokens']}, {'$set': update})
+            if result.matched_count:
+                return tokens, now
+
+        logger.warning("Rate limit bucket of %s is contended, skipping a sync", user)
+        return None
@@ -0,0 +1,66 @@
+import numpy as np
+
+# Placement rules evaluated as numpy masks over the voxels around the target
+# cell, the neighbourhood is decoded from the world chunks once per placement.
+
+OK = 'ok'
+CAPTURE = 'capture'
+TOO_FAR = 'too_far'
+OCCUPIED = 'occupied'
+TOO_CLOSE = 'too_close'
+UNSUPPORTED = 'unsupported'
+NEAR_FLAG = 'near_flag'
+
+NEIGHBOURS_RANGE = 5
+FLAG_RANGE = 4
+
+
+class Neighbourhood(object):
+    def __init__(self, world, x, y, z, range=NEIGHBOURS_RANGE):
+        self.world = world
+        (self.xs, self.ys, self.zs, self.owners, self.named,
+         self.slots, self.chunk_ids, self.chunks) = world.box(
+            x - range, x + range, y - range, y + range, z - range, z + range)
+
+    def __len__(self):
+        return len(self.xs)
+
+    def record(self, i):
+        return self.world.record(self.chunks[self.chunk_ids[i]], int(self.slots[i]),
+                                 int(self.xs[i]), int(self.ys[i]), int(self.zs[i]))
+
+
+def check(world, x, y, z, owner):
+    # Returns (rule, conflict) for placing owner's voxel at x, y, z, where
+    # conflict is the record (or list of records for TOO_CLOSE) the rule hit.
+    # Same outcome as the checks store_voxel used to run over neighbour dicts.
+    hood = Neighbourhood(world, x, y, z)
+
+    dx, dy, dz = hood.xs - x, hood.ys - y, hood.zs - z
+    adx, ady, adz = np.abs(dx), np.abs(dy), np.abs(dz)
+    owned = hood.owners == world.palette_index.get(owner, -1)
+
+    here = np.flatnonzero((dx == 0) & (dy == 0) & (dz == 0))
+    if here.size:
+        i = here[0]
+        if hood.named[i] and not owned[i]:
+            # A foreign flag is captured from own voxels around it
+            return (CAPTURE if owned.any() else TOO_FAR), hood.record(i)
+        return OCCUPIED, hood.record(i)
+
+    near = (adx <= 1) & (ady <= 1) & (adz <= 1)
+
+    others = np.flatnonzero(near & ~owned)
+    if others.size:
+        return TOO_CLOSE, [hood.record(i) for i in others]
+
+    in_line = ((dx == 0) & (dy == 0)) | ((dx == 0) & (dz == 0)) | ((dy == 0) & (dz == 0))
+    if z != 0 and not (near & in_line).any():
+        return UNSUPPORTED, None
+
+    flags = np.flatnonzero(hood.named & (adx <= FLAG_RANGE) & (ady <= FLAG_RANGE) &
+                           (adz <= FLAG_RANGE))
+    if flags.size:
+        return NEAR_FLAG, hood.record(flags[0])
+
+    return OK, None
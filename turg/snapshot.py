@@ -0,0 +1,303 @@
+import asyncio
+import mmap
+import os
+import re
+import struct
+import time
+
+from turg.logger import getLogger
+from turg.world import Chunk, World, to_timestamp
+
+logger = getLogger(__name__)
+
+# Snapshot file layout, numbers in native (little endian) byte order:
+#
+#   header    magic, format version, chunk size, world version, time taken,
+#             palette size, chunk count
+#   palette   u16 length + utf-8 owner for every palette entry
+#   index     cx, cy, cz, voxel count, data offset for every chunk
+#   chunks    8 byte aligned blocks of the chunk arrays: updated (f64),
+#             versions (u64), offsets (u16), owners (u16), then the flag
+#             count (u32) and slot (u16), length (u16), utf-8 name of each flag
+#
+# Chunk arrays are stored exactly as World keeps them, so a chunk is loaded
+# with a copy and can be read in place through the mmap by offline tools.
+
+MAGIC = b'URBS'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sBxHQdII')
+INDEX_ENTRY = struct.Struct('<iiiIQ')
+STRING = struct.Struct('<H')
+COUNT = struct.Struct('<I')
+NAME = struct.Struct('<HH')
+
+# Named by the time taken and the writing process, workers sharing a directory
+# never overwrite each other and the newest file is the latest of any of them
+FILE_NAME = re.compile(r'^world-(\d+)-(\d+)\.snap$')
+
+
+def padding(size):
+    return -size % 8
+
+
+def dump(world, taken=None):
+    # Serialises the world without yielding, so it is a consistent cut
+    taken = time.time() if taken is None else taken
+    chunks = [((cx, cy, cz), chunk)
+              for (cx, cy), column in world.columns.items()
+              for cz, chunk in column.items() if len(chunk)]
+
+    head = [HEADER.pack(MAGIC, FORMAT_VERSION, world.chunk_size, world.version, taken,
+                        len(world.palette), len(chunks))]
+    for owner in world.palette:
+        encoded = owner.encode('utf-8')
+        head.append(STRING.pack(len(encoded)) + encoded)
+
+    size = sum(map(len, head))
+    head.append(bytes(padding(size)))
+    offset = size + padding(size) + INDEX_ENTRY.size * len(chunks)
+
+    index, blocks = [], []
+    for (cx, cy, cz), chunk in chunks:
+        block = [chunk.updated.tobytes(), chunk.versions.tobytes(),
+                 chunk.offsets.tobytes(), chunk.owners.tobytes(), COUNT.pack(len(chunk.names))]
+        for slot, name in chunk.names.items():
+            encoded = name.encode('utf-8')
+            block.append(NAME.pack(slot, len(encoded)) + encoded)
+
+        block = b''.join(block)
+        block += bytes(padding(len(block)))
+        index.append(INDEX_ENTRY.pack(cx, cy, cz, len(chunk), offset))
+        blocks.append(block)
+        offset += len(block)
+
+    return b''.join(head + index + blocks)
+
+
+class Snapshot(object):
+    # Read access to a snapshot file through mmap, usable as a context manager.
+    # `arrays` hands out zero-copy views, release them before closing.
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as snapshot:
+            self.map = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            (magic, format_version, self.chunk_size, self.version, self.taken,
+             palette_size, chunk_count) = HEADER.unpack_from(self.map)
+
+            if magic != MAGIC or format_version != FORMAT_VERSION:
+                raise ValueError(f"{path} is not a version {FORMAT_VERSION} world snapshot")
+
+            offset = HEADER.size
+            self.palette = []
+            for _ in range(palette_size):
+                length, = STRING.unpack_from(self.map, offset)
+                offset += STRING.size
+                self.palette.append(self.map[offset:offset + length].decode('utf-8'))
+                offset += length
+
+            offset += padding(offset)
+            self.index = {}
+            for _ in range(chunk_count):
+                cx, cy, cz, count, data = INDEX_ENTRY.unpack_from(self.map, offset)
+                self.index[cx, cy, cz] = count, data
+                offset += INDEX_ENTRY.size
+        except Exception:
+            self.map.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return sum(count for count, _ in self.index.values())
+
+    def close(self):
+        self.map.close()
+
+    def layout(self, key):
+        count, offset = self.index[key]
+        updated = offset
+        versions = updated + 8 * count
+        offsets = versions + 8 * count
+        owners = offsets + 2 * count
+        names = owners + 2 * count
+
+        return count, updated, versions, offsets, owners, names
+
+    def arrays(self, key):
+        # (updated, versions, offsets, owners) of a chunk as memoryviews of the file
+        count, updated, versions, offsets, owners, names = self.layout(key)
+        view = memoryview(self.map)
+
+        return (view[updated:versions].cast('d'), view[versions:offsets].cast('Q'),
+                view[offsets:owners].cast('H'), view[owners:names].cast('H'))
+
+    def names(self, key):
+        names_offset = self.layout(key)[-1]
+        count, = COUNT.unpack_from(self.map, names_offset)
+        offset = names_offset + COUNT.size
+        names = {}
+
+        for _ in range(count):
+            slot, length = NAME.unpack_from(self.map, offset)
+            offset += NAME.size
+            names[slot] = self.map[offset:offset + length].decode('utf-8')
+            offset += length
+
+        return names
+
+    def chunk(self, key):
+        count, updated, versions, offsets, owners, names = self.layout(key)
+        chunk = Chunk()
+
+        chunk.updated.frombytes(self.map[updated:versions])
+        chunk.versions.frombytes(self.map[versions:offsets])
+        chunk.offsets.frombytes(self.map[offsets:owners])
+        chunk.owners.frombytes(self.map[owners:names])
+        chunk.index = dict(zip(chunk.offsets, range(count)))
+        chunk.names = self.names(key)
+
+        return chunk
+
+    def world(self):
+        world = World(self.chunk_size)
+        world.palette = list(self.palette)
+        world.palette_index = {owner: i for i, owner in enumerate(world.palette)}
+        world.version = self.version
+
+        for (cx, cy, cz) in self.index:
+            world.columns.setdefault((cx, cy), {})[cz] = self.chunk((cx, cy, cz))
+        world.count = len(self)
+
+        return world
+
+
+def snapshots(directory):
+    # Snapshot paths in the directory, latest first
+    try:
+        files = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+
+    found = [((int(match.group(1)), int(match.group(2))), os.path.join(directory, match.group(0)))
+             for match in map(FILE_NAME.match, files) if match]
+
+    return [path for _, path in sorted(found, reverse=True)]
+
+
+def load_latest(directory, chunk_size):
+    # Returns (world, time taken) from the newest readable snapshot with the
+    # configured chunk size, or (None, None)
+    for path in snapshots(directory):
+        try:
+            with Snapshot(path) as snapshot:
+                if snapshot.chunk_size != chunk_size:
+                    logger.warning("Skip snapshot %s with chunk size %s", path,
+                                   snapshot.chunk_size)
+                    continue
+                world = snapshot.world()
+        except Exception:
+            logger.exception("Failed to read snapshot %s", path)
+            continue
+
+        logger.info("Loaded %s voxels from snapshot %s, world version %s",
+                    world.count, path, world.version)
+        return world, snapshot.taken
+
+    return None, None
+
+
+async def server_time(db):
+    # Mongo's clock, the one that stamps the documents replayed on top of a snapshot
+    status = await db.command('isMaster')
+
+    return to_timestamp(status['localTime'])
+
+
+class SnapshotWriter(object):
+    # Periodically writes the world to `directory` and keeps the last `keep`
+    # files of all workers writing there. The world is serialised on the loop,
+    # the file is written in an executor. With `db` the time taken is mongo's,
+    # with `writer` a snapshot is only kept once the writes queued when it was
+    # taken are in mongo, a failed one would leave a voxel no replay removes.
+
+    def __init__(self, world, directory, interval=300, keep=2, db=None, writer=None):
+        self.world = world
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        self.db = db
+        self.writer = writer
+        self.written = None
+        self.task = None
+
+    def save(self, data, taken):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'world-{int(taken * 1000)}-{os.getpid()}.snap')
+
+        temporary = f'{path}.tmp'
+
+        with open(temporary, 'wb') as snapshot:
+            snapshot.write(data)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary, path)
+
+        for old in snapshots(self.directory)[self.keep:]:
+            try:
+                os.remove(old)
+            except FileNotFoundError:
+                # Pruned by another worker
+                pass
+
+        return path
+
+    async def write(self):
+        version = self.world.version
+        if version == self.written:
+            return
+
+        # Taken before the cut, documents stamped in between are replayed again
+        taken = time.time() if self.db is None else await server_time(self.db)
+        version = self.world.version
+        data = dump(self.world, taken)
+        queued = self.writer.outstanding() if self.writer is not None else []
+        if queued:
+            await asyncio.wait(queued)
+            if any(not future.cancelled() and future.exception() for future in queued):
+                logger.warning("Skip snapshot of world version %s, writes queued "
+                               "when it was taken failed", version)
+                return
+
+        loop = asyncio.get_event_loop()
+        path = await loop.run_in_executor(None, self.save, data, taken)
+        self.written = version
+        logger.info("Wrote snapshot %s, %s bytes", path, len(data))
+
+    async def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.write()
+            except Exception:
+                logger.exception("Writing snapshot failed")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+        try:
+            await self.write()
+        except Exception:
+            logger.exception("Writing snapshot failed")
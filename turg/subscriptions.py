@@ -0,0 +1,51 @@
+import math
+from collections import defaultdict
+
+
+class Subscriptions(object):
+    # Area of interest index: every connection is registered in the grid cells
+    # covered by the viewport of its last range request.
+
+    def __init__(self, cell_size=32):
+        self.cell_size = cell_size
+        self.cells = defaultdict(set)
+        self.connections = {}
+
+    def __len__(self):
+        return len(self.connections)
+
+    def cells_for(self, x, y, range):
+        size = self.cell_size
+
+        for cx in range(math.floor(x - range) // size, math.floor(x + range) // size + 1):
+            for cy in range(math.floor(y - range) // size, math.floor(y + range) // size + 1):
+                yield cx, cy
+
+    def update(self, connection, x, y, range):
+        self.remove(connection.ws)
+
+        connection.viewport = {'x': x, 'y': y, 'range': range}
+        self.connections[id(connection.ws)] = connection
+
+        for cell in self.cells_for(x, y, range):
+            self.cells[cell].add(id(connection.ws))
+
+    def remove(self, ws):
+        connection = self.connections.pop(id(ws), None)
+
+        if connection is None or not connection.viewport:
+            return
+
+        viewport = connection.viewport
+        for cell in self.cells_for(viewport['x'], viewport['y'], viewport['range']):
+            subscribers = self.cells.get(cell)
+            if subscribers is None:
+                continue
+            subscribers.discard(id(ws))
+            if not subscribers:
+                del self.cells[cell]
+
+    def candidates(self, x, y):
+        cell = math.floor(x) // self.cell_size, math.floor(y) // self.cell_size
+
+        return [self.connections[ws_id] for ws_id in self.cells.get(cell, ())]
@@ -0,0 +1,101 @@
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+from turg.world import World
+
+# Rough per voxel cost on top of its JSON text: str object, list slot, x and y
+VOXEL_OVERHEAD = 49 + 8 + 16
+TILE_OVERHEAD = 512
+
+
+class Tile(object):
+    # JSON encoded voxels of one tile with their x/y for cutting edge tiles
+    __slots__ = ('voxels', 'xs', 'ys', 'size')
+
+    def __init__(self, voxels):
+        self.voxels = [json.dumps(voxel) for voxel in voxels]
+        self.xs = np.array([voxel['x'] for voxel in voxels], dtype=np.int64)
+        self.ys = np.array([voxel['y'] for voxel in voxels], dtype=np.int64)
+        self.size = (sum(map(len, self.voxels)) + VOXEL_OVERHEAD * len(self.voxels) +
+                     TILE_OVERHEAD)
+
+
+class TileCache(object):
+    # Range replies assembled from pre-encoded tile_size x tile_size columns of
+    # the world. Tiles are built on first use, kept in LRU order under
+    # max_bytes and dropped whenever a voxel inside them changes.
+
+    def __init__(self, world, tile_size=16, max_bytes=64 * 1024 * 1024):
+        self.world = world
+        self.tile_size = tile_size
+        self.max_bytes = max_bytes
+        self.tiles = OrderedDict()
+        self.size = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def tile(self, tx, ty):
+        tile = self.tiles.get((tx, ty))
+
+        if tile is not None:
+            self.tiles.move_to_end((tx, ty))
+            self.stats['hits'] += 1
+            return tile
+
+        self.stats['misses'] += 1
+        size = self.tile_size
+        tile = self.tiles[tx, ty] = Tile(self.world.rect(tx * size, tx * size + size - 1,
+                                                         ty * size, ty * size + size - 1))
+        self.size += tile.size
+
+        while self.size > self.max_bytes and len(self.tiles) > 1:
+            _, evicted = self.tiles.popitem(last=False)
+            self.size -= evicted.size
+            self.stats['evictions'] += 1
+
+        return tile
+
+    def invalidate(self, x, y):
+        tile = self.tiles.pop((x // self.tile_size, y // self.tile_size), None)
+
+        if tile is not None:
+            self.size -= tile.size
+            self.stats['invalidations'] += 1
+
+    def pieces(self, x, y, r):
+        # Yields the JSON encoded voxels of World.area tile by tile
+        x_min, x_max, y_min, y_max = World.bounds(x, y, r)
+        size = self.tile_size
+
+        for tx in range(x_min // size, x_max // size + 1):
+            for ty in range(y_min // size, y_max // size + 1):
+                tile = self.tile(tx, ty)
+
+                if not tile.voxels:
+                    continue
+
+                if (x_min <= tx * size and tx * size + size - 1 <= x_max and
+                        y_min <= ty * size and ty * size + size - 1 <= y_max):
+                    encoded = tile.voxels
+                else:
+                    inside = np.flatnonzero((tile.xs >= x_min) & (tile.xs <= x_max) &
+                                            (tile.ys >= y_min) & (tile.ys <= y_max))
+                    encoded = [tile.voxels[i] for i in inside.tolist()]
+
+                if encoded:
+                    yield encoded
+
+    def area(self, x, y, r):
+        # Returns the comma separated JSON voxels of World.area and their count
+        parts = []
+        count = 0
+
+        for encoded in self.pieces(x, y, r):
+            parts.append(','.join(encoded))
+            count += len(encoded)
+
+        return ','.join(parts), count
@@ -1,26 +1,101 @@
-from time import time
+import asyncio
+import time
+
 from aiohttp import web
 
 from turg.config import Config
 from turg.logger import getLogger
-from turg.models import get_leaders
+from turg.models import get_leaders, get_owner_names
 
 logger = getLogger()
 config = Config()
 
 
 class Leaders(web.View):
-    cache = None
-    cache_ts = None
-
     async def get(self):
-        now = time()
+        try:
+            limit = int(self.request.query['limit'])
+            if limit < 0:
+                raise ValueError(limit)
+        except KeyError:
+            limit = None
+        except ValueError:
+            return web.json_response(
+                {'error': {'message': 'limit must be a non-negative integer'}}, status=400)
+
+        leaders = await get_leaders(self.request.app, limit)
+
+        return web.json_response(leaders, status=200, headers={
+            'Cache-Control': f'max-age={config.cache_seconds}',
+        })
+
+
+class LeaderboardFeed(object):
+    # Pushes rank changes to subscribed sockets after flag captures,
+    # at most once per interval.
+
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self.subscribers = {}
+        self.ranks = {}
+        self.handle = None
+        self.last_push = 0
+
+    def standings(self):
+        names = get_owner_names(self.app['users'])
+
+        return [{'owner': owner, 'name': names.get(owner, owner), 'time': seconds, 'rank': rank}
+                for rank, (owner, seconds) in enumerate(self.app['ranking'].top(), 1)]
+
+    def subscribe(self, ws):
+        # The first subscriber sets the ranks later pushes are compared with
+        first = not self.subscribers
+        self.subscribers[id(ws)] = ws
+        standings = self.standings()
+
+        if first:
+            self.ranks = {row['owner']: row['rank'] for row in standings}
+
+        return standings
+
+    def unsubscribe(self, ws):
+        self.subscribers.pop(id(ws), None)
+
+        if not self.subscribers:
+            self.close()
+
+    def changed(self):
+        if self.handle is not None or not self.subscribers:
+            return
+
+        delay = max(0, self.last_push + self.interval - time.monotonic())
+        self.handle = asyncio.get_event_loop().call_later(delay, self.push)
+
+    def push(self):
+        self.handle = None
+        self.last_push = time.monotonic()
+
+        if not self.subscribers:
+            return
+
+        standings = self.standings()
+        diff = [row for row in standings if self.ranks.get(row['owner']) != row['rank']]
+        self.ranks = {row['owner']: row['rank'] for row in standings}
+
+        if not diff:
+            return
 
-        if Leaders.cache is None or now > Leaders.cache_ts + config.cache_seconds:
-            Leaders.cache = await get_leaders(self.request.app)
-            Leaders.cache_ts = now
+        logger.info("Push %s leaderboard changes to %s sockets", len(diff), len(self.subscribers))
+        self.app['broadcaster'].publish({
+            'data': diff,
+            'meta': {'type': 'leaderboard', 'full': False},
+        }, list(self.subscribers.values()))
 
-        return web.json_response(Leaders.cache, status=200)
+    def close(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
 
 
 def factory(app):
@@ -0,0 +1,58 @@
+from aiohttp import web
+
+from turg.logger import getLogger
+from turg.metrics import REGISTRY
+
+logger = getLogger()
+
+
+def labelled(values, label):
+    return {((label, key),): value for key, value in values.items()}
+
+
+def register_gauges(app):
+    REGISTRY.gauge('turg_websockets', 'Open websocket connections',
+                   lambda: len(app['connections']))
+    REGISTRY.gauge('turg_connection_registry_bytes', 'Approximate connection registry size',
+                   lambda: app['connections'].memory())
+    REGISTRY.gauge('turg_viewports', 'Sockets subscribed to an area',
+                   lambda: len(app['subscriptions']))
+    REGISTRY.gauge('turg_broadcast_queue_depth', 'Frames waiting in socket send queues',
+                   lambda: app['broadcaster'].queue_depth()[0])
+    REGISTRY.gauge('turg_broadcast_max_queue_depth', 'Deepest socket send queue',
+                   lambda: app['broadcaster'].queue_depth()[1])
+    REGISTRY.counter('turg_broadcast_total', 'Broadcast engine counters',
+                     lambda: labelled(app['broadcaster'].stats, 'stat'))
+    REGISTRY.counter('turg_writer_total', 'Batched writer counters',
+                     lambda: labelled(app['writer'].stats, 'stat'))
+    REGISTRY.counter('turg_ws_compression_total', 'Websocket frames and bytes by compression',
+                     lambda: labelled(app['compression'].report(), 'stat'))
+    REGISTRY.counter('turg_ws_compression_seconds_total', 'Time spent deflating websocket frames',
+                     lambda: app['compression'].seconds)
+    REGISTRY.gauge('turg_world_voxels', 'Voxels in the world index',
+                   lambda: len(app['world']))
+    REGISTRY.gauge('turg_world_version', 'Current world version',
+                   lambda: app['world'].version)
+    REGISTRY.gauge('turg_tile_cache_bytes', 'Approximate size of cached range tiles',
+                   lambda: app['tiles'].size)
+    REGISTRY.counter('turg_tile_cache_total', 'Range tile cache counters',
+                     lambda: labelled(app['tiles'].stats, 'stat'))
+    REGISTRY.gauge('turg_rate_limit_buckets', 'Rate limiter buckets held in memory',
+                   lambda: len(app['limiter'].cache))
+
+
+class Metrics(web.View):
+    async def get(self):
+        return web.Response(body=REGISTRY.render().encode('utf-8'), status=200, headers={
+            'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+        })
+
+
+def factory(app):
+    register_gauges(app)
+
+    return {
+        'method': 'GET',
+        'path': '/v1/metrics',
+        'handler': Metrics,
+    }
@@ -1,40 +1,52 @@
+import asyncio
 import json
 import attr
 import time
 from aiohttp import web, WSMsgType
-from aiohttp.web import WebSocketResponse
 
+from turg.compression import PolicyWebSocketResponse
 from turg.config import Config
-from turg.logger import getLogger
-from turg.models import get_voxels, verify_payload, store_voxel, Voxel
+from turg.connections import Connection
+from turg.logger import getLogger, sampled
+from turg.metrics import (
+    BROADCAST_RECIPIENTS,
+    BROADCAST_SECONDS,
+    RANGE_VOXELS,
+    RATE_LIMITED,
+    REQUEST_SECONDS,
+)
+from turg.models import (
+    get_voxels, get_voxels_json, verify_payload, store_voxel, voxel_pages, Voxel,
+)
+from turg.world import from_timestamp, to_timestamp
 from turg.firebase import get_token_payload, get_user_color
+from turg.wire import MAX_ID_LENGTH, encode_range, id_length
 
 logger = getLogger()
+hot_logger = sampled(logger)
 config = Config()
 
+PROTOCOLS = ('json', 'binary')
+REQUEST_TYPES = ('range', 'update', 'leaderboard')
 
-def get_ws_by_id(_id, app):
-    for item in app['websockets']:
-        if id(item) == _id:
-            return item
 
-    return None
+def forget_connection(ws, app):
+    connection = app['connections'].remove(ws)
+    app['subscriptions'].remove(ws)
+    app['broadcaster'].unregister(ws)
+    app['leaderboard_feed'].unsubscribe(ws)
+
+    return connection
 
 
 async def close_old_user_connections(color, app):
-    old_ws_id = app['colors_websocket'][color]
-    old_ws = get_ws_by_id(old_ws_id, app)
+    old = app['connections'].get_by_color(color)
 
-    if old_ws:
+    if old:
         logger.info("Close old WS connections for %s", color)
 
-        await old_ws.close()
-
-        if old_ws in app['websockets']:
-            app['websockets'].remove(old_ws)
-
-        app['websockets_colors'].pop(id(old_ws), None)
-        app['colors_websocket'].pop(color, None)
+        await old.ws.close()
+        forget_connection(old.ws, app)
 
 
 class WebSocket(web.View):
@@ -48,6 +60,12 @@ class WebSocket(web.View):
             return web.json_response(
                 {'error': {'message': 'Data not valid'}}, status=400)
 
+        protocol = self.request.query.get('protocol', 'json')
+        if protocol not in PROTOCOLS:
+            logger.error("Unknown protocol %s", protocol)
+            return web.json_response(
+                {'error': {'message': 'Unknown protocol'}}, status=400)
+
         try:
             payload = await get_token_payload(token, app)
             uid = payload['user_id']
@@ -68,15 +86,17 @@ class WebSocket(web.View):
             logger.exception("No user color")
             return web.json_response(status=401)
 
-        if color in app['colors_websocket']:
-            await close_old_user_connections(color, app)
+        await close_old_user_connections(color, app)
+
+        await app['backplane'].publish({
+            'kind': 'login', 'uid': uid, 'name': name, 'color': color,
+        })
 
-        ws = WebSocketResponse(compress=True)
+        ws = PolicyWebSocketResponse(app['compression'])
         await ws.prepare(self.request)
 
-        app['websockets'].append(ws)
-        app['colors_websocket'][color] = id(ws)
-        app['websockets_colors'][id(ws)] = color
+        connection = app['connections'].add(Connection(ws, uid, name, color, protocol))
+        app['broadcaster'].register(ws)
 
         await ws.send_json({
             'data': {'color': color},
@@ -87,33 +107,36 @@ class WebSocket(web.View):
         ratelimiter = app['limiter']
 
         async for msg in ws:
-            logger.info("MSG: %s", msg)
-            if ratelimiter.limit_exceeded(uid):
-                logger.error("Rate limit for user %s exceeded", uid)
-                msg = f'Requests limit of {ratelimiter.requests} per minute exceeded'
-                await ws.send_json({'error': {'message': msg}})
-                continue
+            hot_logger.debug("MSG: %s", msg)
+            connection.touch()
             if msg.tp == WSMsgType.text:
                 if msg.data == 'close':
                     logger.info("Close ws connection")
                     await ws.close()
-                else:
-                    try:
-                        data = json.loads(msg.data)
-                    except:
-                        pass
-                    else:
-                        logger.info("Got request: %s", data)
-                        await process_request(data, ws, app, name)
+                    continue
+
+                try:
+                    data = json.loads(msg.data)
+                except:
+                    data = None
+
+                kind = data.get('type') if isinstance(data, dict) else None
+                kind = str(kind).lower()
+                if await ratelimiter.limit_exceeded(uid, kind):
+                    hot_logger.warning("Rate limit for user %s exceeded", uid)
+                    RATE_LIMITED.inc(type=kind if kind in REQUEST_TYPES else 'unknown')
+                    msg = f'Requests limit of {ratelimiter.requests} per minute exceeded'
+                    await ws.send_json({'error': {'message': msg}})
+                    continue
+
+                if data is not None:
+                    hot_logger.debug("Got request: %s", data)
+                    await process_request(data, connection, app)
 
             elif msg.tp == WSMsgType.error:
                 logger.exception("Got ws error %s", id(ws))
 
-        if ws in app['websockets']:
-            app['websockets'].remove(ws)
-
-        app['websockets_colors'].pop(id(ws), None)
-        app['colors_websocket'].pop(color, None)
+        forget_connection(ws, app)
 
         await user_logout_broadcast(name, app)
 
@@ -129,44 +152,129 @@ def factory(app):
     }
 
 
-async def process_request(data, ws, app, name):
+async def process_request(data, connection, app):
+    ws = connection.ws
+
     if not isinstance(data, dict) or 'type' not in data or 'args' not in data:
         return {'error': {'message': {'Method and args required'}}}
 
     _id = data.get('id', None)
     _type = data['type'].lower()
     args = data['args']
-    meta = {'id': _id, 'type': _type}
 
-    if _type == 'range':
-        await retrieve(args, ws, app, meta)
-    elif _type == 'update':
-        await place(args, ws, app, meta, name)
-    else:
-        await ws.send_json({
-            'error': {'message': {'Unknown method or no method specified'}},
-            'meta': meta,
+    if id_length(_id) > MAX_ID_LENGTH:
+        return await ws.send_json({
+            'error': {'message': f'Request id longer than {MAX_ID_LENGTH} bytes'},
+            'meta': {'type': _type},
         })
 
+    meta = {'id': _id, 'type': _type}
 
-async def retrieve(args, ws, app, meta):
+    with REQUEST_SECONDS.time(type=_type if _type in REQUEST_TYPES else 'unknown'):
+        if _type == 'range':
+            await retrieve(args, connection, app, meta)
+        elif _type == 'update':
+            await place(args, connection, app, meta)
+        elif _type == 'leaderboard':
+            await subscribe_leaderboard(args, ws, app, meta)
+        else:
+            await ws.send_json({
+                'error': {'message': {'Unknown method or no method specified'}},
+                'meta': meta,
+            })
+
+
+async def retrieve(args, connection, app, meta):
+    ws = connection.ws
     start_time = time.time()
     x, y, r = args.get('x', 0), args.get('y', 0), args.get('range', 25)
+    since = args.get('since')
 
     if r <= 0:
         r = 25
     elif r > config.max_range:
         r = config.max_range
 
-    voxels = await get_voxels(x, y, r, app['db'])
+    world = app['world']
+    # A version is only comparable within the world that handed it out
+    if (not isinstance(since, int) or not 0 <= since <= world.version or
+            args.get('epoch') != world.epoch):
+        since = None
 
-    logger.info("Get voxels for range (x - %s, y - %s, range - %s) – (%.02fs)",
-                x, y, r, time.time() - start_time)
+    if args.get('stream'):
+        return await stream(x, y, r, since, connection, app, meta)
 
-    await ws.send_json({'data': voxels, 'meta': meta})
+    if since is None and connection.protocol == 'json':
+        # Full JSON areas are assembled from pre-encoded tiles
+        voxels = await get_voxels_json(x, y, r, app)
+    else:
+        voxels = await get_voxels(x, y, r, app, since)
+    app['subscriptions'].update(connection, x, y, r)
+    meta.update({'version': world.version, 'since': since, 'epoch': world.epoch})
+
+    hot_logger.info("Get voxels for range (x - %s, y - %s, range - %s, since - %s) – (%.02fs)",
+                    x, y, r, since, time.time() - start_time)
 
+    if connection.protocol == 'binary':
+        await ws.send_bytes(encode_range(voxels, meta))
+    elif isinstance(voxels, str):
+        await ws.send_str(f'{{"data": [{voxels}], "meta": {json.dumps(meta)}}}')
+    else:
+        await ws.send_json({'data': voxels, 'meta': meta})
 
-async def place(args, ws, app, meta, name):
+
+async def stream(x, y, r, since, connection, app, meta):
+    # Sends the area as frames of range_page_size voxels, each with the request
+    # id, a sequence number and an end marker. Pages are read as they are sent,
+    # changes made meanwhile reach the client as broadcasts. The version of the
+    # first frames is only a lower bound, the end frame carries the world
+    # version once the last page was read, the one to send as `since` next time.
+    ws = connection.ws
+    start_time = time.time()
+    encoded = since is None and connection.protocol == 'json'
+    count = 0
+
+    app['subscriptions'].update(connection, x, y, r)
+    meta.update({'version': app['world'].version, 'since': since, 'epoch': app['world'].epoch})
+
+    for seq, (page, end) in enumerate(voxel_pages(x, y, r, app, since, encoded)):
+        if ws.closed:
+            return
+
+        page_meta = dict(meta, seq=seq, end=end)
+        if end:
+            page_meta['version'] = app['world'].version
+        if connection.protocol == 'binary':
+            await ws.send_bytes(encode_range(page, page_meta))
+        elif encoded:
+            await ws.send_str(f'{{"data": [{",".join(page)}], "meta": {json.dumps(page_meta)}}}')
+        else:
+            await ws.send_json({'data': page, 'meta': page_meta})
+        count += len(page)
+
+        if not end:
+            # Lets other requests run between the pages of a large area
+            await asyncio.sleep(0)
+
+    RANGE_VOXELS.observe(count)
+    hot_logger.info("Streamed %s voxels in %s frames for range (x - %s, y - %s, range - %s, "
+                    "since - %s) – (%.02fs)", count, seq + 1, x, y, r, since,
+                    time.time() - start_time)
+
+
+async def subscribe_leaderboard(args, ws, app, meta):
+    feed = app['leaderboard_feed']
+
+    if args.get('subscribe', True):
+        meta['full'] = True
+        await ws.send_json({'data': feed.subscribe(ws), 'meta': meta})
+    else:
+        feed.unsubscribe(ws)
+        await ws.send_json({'data': [], 'meta': meta})
+
+
+async def place(args, connection, app, meta):
+    ws = connection.ws
     start_time = time.time()
     args.pop('name', None)
     if not verify_payload(args):
@@ -176,11 +284,11 @@ async def place(args, ws, app, meta, name):
         })
 
     try:
-        args['owner'] = app['websockets_colors'][id(ws)]
-        logger.info('WS color: %s', args['owner'])
+        args['owner'] = connection.color
+        hot_logger.debug('WS color: %s', args['owner'])
         voxel = await store_voxel(Voxel(**args), app)
-        logger.info("Store voxel – (%.02fs)",
-                    time.time() - start_time)
+        hot_logger.info("Store voxel – (%.02fs)",
+                        time.time() - start_time)
     except (ValueError, KeyError) as e:
         res = {
             'error': {'message': str(e)},
@@ -190,15 +298,31 @@ async def place(args, ws, app, meta, name):
             res['error'] = e.args[0]
         return await ws.send_json(res)
     else:
-        if getattr(voxel, 'captured', None):
-            await broadcast(voxel, app, meta)
-            return await flag_captured(name, voxel.name, app)
+        sockets = interested_sockets(voxel, app)
+        if ws not in sockets:
+            sockets.append(ws)
+
+        key = (voxel.x, voxel.y, voxel.z)
+        captured = bool(getattr(voxel, 'captured', None))
+
+        await broadcast(voxel, app, meta, sockets, key)
+        await app['backplane'].publish({
+            'kind': 'voxel',
+            'voxel': {
+                'x': voxel.x, 'y': voxel.y, 'z': voxel.z, 'owner': voxel.owner,
+                'name': voxel.name, 'updated': to_timestamp(voxel.updated),
+            },
+            'captured': captured,
+            'meta': meta,
+        })
 
-        return await broadcast(voxel, app, meta)
+        if captured:
+            app['leaderboard_feed'].changed()
+            return await flag_captured(connection.name, voxel.name, app)
 
 
 async def flag_captured(name, flag, app):
-    await broadcast({
+    await broadcast_everywhere({
         'name': name,
         'flag': flag,
     }, app, {
@@ -207,7 +331,7 @@ async def flag_captured(name, flag, app):
 
 
 async def user_login_broadcast(name, app):
-    await broadcast({
+    await broadcast_everywhere({
         'name': name,
     }, app, {
         'type': 'userLogin',
@@ -215,26 +339,71 @@ async def user_login_broadcast(name, app):
 
 
 async def user_logout_broadcast(name, app):
-    await broadcast({
+    await broadcast_everywhere({
         'name': name,
     }, app, {
         'type': 'userLogout',
     })
 
 
-async def broadcast(data, app, meta):
+async def broadcast(data, app, meta, sockets=None, key=None):
     if not isinstance(data, dict):
         data = attr.asdict(data)
         data.pop('updated', None)
+        data.pop('version', None)
         if not data.get('name'):
             data.pop('name', None)
 
-    for ws in app['websockets']:
-        try:
-            await ws.send_json({'data': data, 'meta': meta})
-            logger.info("Broadcast data %s for %s", meta.get('id'), id(ws))
-        except:
-            logger.exception("Failed to send update to socket %s", id(ws))
+    if sockets is None:
+        sockets = app['connections'].sockets()
+
+    with BROADCAST_SECONDS.time():
+        app['broadcaster'].publish({'data': data, 'meta': meta}, sockets, key)
+    BROADCAST_RECIPIENTS.observe(len(sockets))
+    hot_logger.info("Broadcast data %s for %s sockets", meta.get('id'), len(sockets))
+
+
+async def broadcast_everywhere(data, app, meta):
+    await broadcast(data, app, meta)
+    await app['backplane'].publish({'kind': 'broadcast', 'data': data, 'meta': meta})
+
+
+async def handle_event(app, event):
+    # Events published by the other nodes through the backplane
+    kind = event.get('kind')
+
+    if kind == 'broadcast':
+        await broadcast(event['data'], app, event['meta'])
+
+    elif kind == 'voxel':
+        record = event['voxel']
+        voxel = Voxel(record['x'], record['y'], record['z'], record['owner'],
+                      record['name'], from_timestamp(record['updated']))
+
+        # Placements on different workers are not validated against each other.
+        # Conflicting ones resolve to the newest everywhere, as the conditional
+        # write in store_voxel does in mongo.
+        current = app['world'].get(voxel.x, voxel.y, voxel.z)
+        if (current and current['updated'] and voxel.updated and
+                current['updated'] > voxel.updated):
+            return
+
+        # Re-stamped with a local version, delta reads only trust this world's epoch
+        voxel.version = app['world'].set(voxel.x, voxel.y, voxel.z, voxel.owner,
+                                         voxel.name, voxel.updated)
+        app['tiles'].invalidate(voxel.x, voxel.y)
+        if event['captured']:
+            app['ranking'].capture((voxel.x, voxel.y, voxel.z), voxel.owner, voxel.updated)
+            app['leaderboard_feed'].changed()
+
+        await broadcast(voxel, app, event['meta'], interested_sockets(voxel, app),
+                        (voxel.x, voxel.y, voxel.z))
+
+    elif kind == 'login':
+        user = app['users'].setdefault(event['uid'], {})
+        user.update({'name': event['name'], 'color': event['color']})
+
+        await close_old_user_connections(event['color'], app)
 
 
 def in_range(voxel, position):
@@ -243,3 +412,8 @@ def in_range(voxel, position):
     y_in_range = y - r < voxel.y < y + r
 
     return x_in_range and y_in_range
+
+
+def interested_sockets(voxel, app):
+    return [connection.ws for connection in app['subscriptions'].candidates(voxel.x, voxel.y)
+            if in_range(voxel, connection.viewport)]
@@ -0,0 +1,147 @@
+import json
+import struct
+import sys
+from array import array
+
+# Binary frames, all integers little-endian:
+#
+#   header   4s magic 'URBN', u8 format version, u8 message type, u16 id length
+#   id       JSON encoded request id
+#   page     range pages only: u32 sequence number, u8 end marker
+#   body     u64 world version, u64 delta base version (0 for a full area), u64 world epoch,
+#            u32 voxel count, u16 palette size, u16 flag count, u8 coordinate width
+#   palette  per owner: u8 length, utf-8 owner colour
+#   voxels   x array, y array, z array (u16 or u32 each), owner palette indices (u16)
+#   flags    per flag: u32 voxel index, u8 length, utf-8 name
+
+MAGIC = b'URBN'
+FORMAT_VERSION = 3
+RANGE = 1
+RANGE_PAGE = 2
+
+HEADER = struct.Struct('<4sBBH')
+RANGE_BODY = struct.Struct('<QQQIHHB')
+PAGE = struct.Struct('<IB')
+FLAG_INDEX = struct.Struct('<I')
+
+COORD_TYPES = {2: 'H', 4: 'I'}
+
+# Longest JSON encoded request id accepted, well within the u16 id length
+MAX_ID_LENGTH = 256
+
+
+def pack_array(typecode, values):
+    packed = array(typecode, values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+
+    return packed.tobytes()
+
+
+def unpack_array(typecode, data, offset, count):
+    packed = array(typecode)
+    packed.frombytes(data[offset:offset + count * packed.itemsize])
+    if sys.byteorder == 'big':
+        packed.byteswap()
+
+    return packed, offset + count * packed.itemsize
+
+
+def pack_string(value):
+    encoded = value.encode('utf-8')[:255]
+
+    return struct.pack('<B', len(encoded)) + encoded
+
+
+def unpack_string(data, offset):
+    length = data[offset]
+
+    return data[offset + 1:offset + 1 + length].decode('utf-8'), offset + 1 + length
+
+
+def id_length(_id):
+    return len(json.dumps(_id).encode('utf-8'))
+
+
+def encode_header(message_type, meta):
+    _id = json.dumps(meta.get('id')).encode('utf-8')
+
+    return HEADER.pack(MAGIC, FORMAT_VERSION, message_type, len(_id)) + _id
+
+
+def encode_range(voxels, meta):
+    palette = {}
+    xs, ys, zs, owners = [], [], [], []
+    flags = []
+
+    for index, voxel in enumerate(voxels):
+        xs.append(voxel['x'])
+        ys.append(voxel['y'])
+        zs.append(voxel['z'])
+        owners.append(palette.setdefault(voxel['owner'], len(palette)))
+        if voxel.get('name'):
+            flags.append((index, voxel['name']))
+
+    width = 2 if max(xs + ys + zs, default=0) < 1 << 16 else 4
+    typecode = COORD_TYPES[width]
+
+    if 'seq' in meta:
+        header = encode_header(RANGE_PAGE, meta) + PAGE.pack(meta['seq'], meta['end'])
+    else:
+        header = encode_header(RANGE, meta)
+
+    parts = [
+        header,
+        RANGE_BODY.pack(meta.get('version') or 0, meta.get('since') or 0, meta.get('epoch') or 0,
+                        len(owners), len(palette), len(flags), width),
+    ]
+    parts.extend(pack_string(owner) for owner in palette)
+    parts.append(pack_array(typecode, xs))
+    parts.append(pack_array(typecode, ys))
+    parts.append(pack_array(typecode, zs))
+    parts.append(pack_array('H', owners))
+    for index, name in flags:
+        parts.append(FLAG_INDEX.pack(index) + pack_string(name))
+
+    return b''.join(parts)
+
+
+def decode_range(data):
+    magic, version, message_type, id_length = HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION or message_type not in (RANGE, RANGE_PAGE):
+        raise ValueError("Not a range frame")
+
+    offset = HEADER.size
+    meta = {'id': json.loads(data[offset:offset + id_length].decode('utf-8')), 'type': 'range'}
+    offset += id_length
+
+    if message_type == RANGE_PAGE:
+        seq, end = PAGE.unpack_from(data, offset)
+        meta.update({'seq': seq, 'end': bool(end)})
+        offset += PAGE.size
+
+    (version, since, epoch, count, palette_size, flag_count,
+     width) = RANGE_BODY.unpack_from(data, offset)
+    offset += RANGE_BODY.size
+    meta.update({'version': version, 'since': since or None, 'epoch': epoch})
+
+    palette = []
+    for _ in range(palette_size):
+        owner, offset = unpack_string(data, offset)
+        palette.append(owner)
+
+    typecode = COORD_TYPES[width]
+    xs, offset = unpack_array(typecode, data, offset, count)
+    ys, offset = unpack_array(typecode, data, offset, count)
+    zs, offset = unpack_array(typecode, data, offset, count)
+    owners, offset = unpack_array('H', data, offset, count)
+
+    voxels = [{'x': x, 'y': y, 'z': z, 'owner': palette[owner]}
+              for x, y, z, owner in zip(xs, ys, zs, owners)]
+
+    for _ in range(flag_count):
+        index, = FLAG_INDEX.unpack_from(data, offset)
+        name, offset = unpack_string(data, offset + FLAG_INDEX.size)
+        voxels[index]['name'] = name
+
+    return voxels, meta
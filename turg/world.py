@@ -0,0 +1,361 @@
+import math
+import os
+from array import array
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from turg.logger import getLogger
+from turg.metrics import MONGO_SECONDS
+
+logger = getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_timestamp(updated):
+    if updated is None:
+        return math.nan
+
+    return (updated - EPOCH).total_seconds()
+
+
+def from_timestamp(ts):
+    if math.isnan(ts):
+        return None
+
+    return EPOCH + timedelta(seconds=ts)
+
+
+class Chunk(object):
+    # Voxels are appended to parallel arrays and never removed, `index` maps a
+    # local offset inside the chunk to the voxel slot. Flag names are sparse.
+    __slots__ = ('index', 'offsets', 'owners', 'updated', 'versions', 'names', 'grid')
+
+    def __init__(self):
+        self.index = {}
+        self.offsets = array('H')
+        self.owners = array('H')
+        self.updated = array('d')
+        self.versions = array('Q')
+        self.names = {}
+        self.grid = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+class World(object):
+    # Spatial hash of cubic chunks grouped by (x, y) column, so area reads only
+    # touch the columns they overlap. Owners are stored as palette indices.
+    # Every change is stamped with the next world version, so readers can ask
+    # for what changed since a version they already have. Versions only mean
+    # something within one world, which is told apart from others (other
+    # workers, earlier runs) by its random epoch, small enough for JS numbers.
+
+    def __init__(self, chunk_size=16):
+        self.chunk_size = chunk_size
+        self.columns = {}
+        self.palette = []
+        self.palette_index = {}
+        self.count = 0
+        self.version = 0
+        self.epoch = int.from_bytes(os.urandom(7), 'little') >> 3
+
+    def __len__(self):
+        return self.count
+
+    def owner_id(self, owner):
+        try:
+            return self.palette_index[owner]
+        except KeyError:
+            self.palette.append(owner)
+            self.palette_index[owner] = len(self.palette) - 1
+            return self.palette_index[owner]
+
+    def locate(self, x, y, z):
+        size = self.chunk_size
+        cx, lx = divmod(x, size)
+        cy, ly = divmod(y, size)
+        cz, lz = divmod(z, size)
+
+        return (cx, cy), cz, (lz * size + ly) * size + lx
+
+    def chunk(self, column, cz, create=False):
+        chunks = self.columns.get(column)
+
+        if chunks is None:
+            if not create:
+                return None
+            chunks = self.columns[column] = {}
+
+        chunk = chunks.get(cz)
+
+        if chunk is None and create:
+            chunk = chunks[cz] = Chunk()
+
+        return chunk
+
+    def set(self, x, y, z, owner, name=None, updated=None, version=None):
+        if version is None:
+            self.version += 1
+            version = self.version
+        else:
+            self.version = max(self.version, version)
+
+        column, cz, offset = self.locate(x, y, z)
+        chunk = self.chunk(column, cz, create=True)
+        slot = chunk.index.get(offset)
+
+        if slot is None:
+            slot = chunk.index[offset] = len(chunk.offsets)
+            chunk.offsets.append(offset)
+            chunk.owners.append(self.owner_id(owner))
+            chunk.updated.append(to_timestamp(updated))
+            chunk.versions.append(version)
+            self.count += 1
+        else:
+            chunk.owners[slot] = self.owner_id(owner)
+            chunk.updated[slot] = to_timestamp(updated)
+            chunk.versions[slot] = version
+
+        if name:
+            chunk.names[slot] = name
+        else:
+            chunk.names.pop(slot, None)
+
+        if chunk.grid is not None:
+            chunk.grid[offset] = -(slot + 1) if name else slot + 1
+
+        return version
+
+    def remove(self, x, y, z):
+        # Takes back a voxel whose write failed. The last slot of the chunk
+        # moves into the freed one, so slots stay dense. Delta reads can't
+        # express removals, the version is left alone.
+        column, cz, offset = self.locate(x, y, z)
+        chunk = self.chunk(column, cz)
+        slot = chunk.index.pop(offset, None) if chunk is not None else None
+
+        if slot is None:
+            return False
+
+        last = len(chunk.offsets) - 1
+        name = chunk.names.pop(last, None)
+        chunk.names.pop(slot, None)
+
+        if slot != last:
+            moved = chunk.offsets[slot] = chunk.offsets[last]
+            chunk.owners[slot] = chunk.owners[last]
+            chunk.updated[slot] = chunk.updated[last]
+            chunk.versions[slot] = chunk.versions[last]
+            chunk.index[moved] = slot
+            if name:
+                chunk.names[slot] = name
+            if chunk.grid is not None:
+                chunk.grid[moved] = -(slot + 1) if name else slot + 1
+
+        for values in (chunk.offsets, chunk.owners, chunk.updated, chunk.versions):
+            values.pop()
+
+        if chunk.grid is not None:
+            chunk.grid[offset] = 0
+
+        self.count -= 1
+        return True
+
+    def add(self, doc):
+        # Documents written before versions existed count as version 0
+        return self.set(doc['x'], doc['y'], doc['z'], doc['owner'],
+                        doc.get('name'), doc.get('updated'), doc.get('version', 0))
+
+    def get(self, x, y, z):
+        column, cz, offset = self.locate(x, y, z)
+        chunk = self.chunk(column, cz)
+
+        if chunk is None:
+            return None
+
+        slot = chunk.index.get(offset)
+
+        if slot is None:
+            return None
+
+        return self.record(chunk, slot, x, y, z)
+
+    def record(self, chunk, slot, x, y, z):
+        return {
+            'x': x,
+            'y': y,
+            'z': z,
+            'owner': self.palette[chunk.owners[slot]],
+            'name': chunk.names.get(slot),
+            'updated': from_timestamp(chunk.updated[slot]),
+            'version': chunk.versions[slot],
+        }
+
+    def scan(self, x_min, x_max, y_min, y_max, z_min, z_max):
+        # Yields (chunk, slot, x, y, z) for every voxel in the inclusive box.
+        # Sparse chunks are walked slot by slot, dense ones are probed cell by cell.
+        size = self.chunk_size
+
+        for cx in range(x_min // size, x_max // size + 1):
+            for cy in range(y_min // size, y_max // size + 1):
+                chunks = self.columns.get((cx, cy))
+
+                if not chunks:
+                    continue
+
+                lx0, lx1 = max(x_min - cx * size, 0), min(x_max - cx * size, size - 1)
+                ly0, ly1 = max(y_min - cy * size, 0), min(y_max - cy * size, size - 1)
+
+                for cz, chunk in chunks.items():
+                    lz0 = max(z_min - cz * size, 0)
+                    lz1 = min(z_max - cz * size, size - 1)
+
+                    if lz0 > lz1:
+                        continue
+
+                    volume = (lx1 - lx0 + 1) * (ly1 - ly0 + 1) * (lz1 - lz0 + 1)
+
+                    if volume < len(chunk):
+                        for lz in range(lz0, lz1 + 1):
+                            for ly in range(ly0, ly1 + 1):
+                                base = (lz * size + ly) * size
+                                for lx in range(lx0, lx1 + 1):
+                                    slot = chunk.index.get(base + lx)
+                                    if slot is not None:
+                                        yield (chunk, slot, cx * size + lx,
+                                               cy * size + ly, cz * size + lz)
+                        continue
+
+                    for slot, offset in enumerate(chunk.offsets):
+                        rest, lx = divmod(offset, size)
+                        lz, ly = divmod(rest, size)
+
+                        if lx0 <= lx <= lx1 and ly0 <= ly <= ly1 and lz0 <= lz <= lz1:
+                            yield chunk, slot, cx * size + lx, cy * size + ly, cz * size + lz
+
+    def grid(self, chunk):
+        # Dense cell -> slot + 1 lookup of a chunk, negative for flags. Built on
+        # first use so only chunks placements look at pay for it, then kept up to date.
+        if chunk.grid is None:
+            offsets = np.frombuffer(chunk.offsets, dtype=np.uint16)
+            chunk.grid = np.zeros(self.chunk_size ** 3, dtype=np.int32)
+            chunk.grid[offsets] = np.arange(1, len(offsets) + 1)
+            for slot in chunk.names:
+                chunk.grid[offsets[slot]] = -(slot + 1)
+
+        return chunk.grid
+
+    def box(self, x_min, x_max, y_min, y_max, z_min, z_max):
+        # Voxels of the inclusive box as parallel numpy arrays: x, y, z, owner
+        # palette index, flag mask, and the chunk list index and slot of every
+        # voxel so a record can be built for it.
+        size = self.chunk_size
+        chunks, parts = [], []
+
+        for cx in range(x_min // size, x_max // size + 1):
+            for cy in range(y_min // size, y_max // size + 1):
+                chunks_column = self.columns.get((cx, cy))
+
+                if not chunks_column:
+                    continue
+
+                lx0, lx1 = max(x_min - cx * size, 0), min(x_max - cx * size, size - 1)
+                ly0, ly1 = max(y_min - cy * size, 0), min(y_max - cy * size, size - 1)
+
+                for cz, chunk in chunks_column.items():
+                    lz0 = max(z_min - cz * size, 0)
+                    lz1 = min(z_max - cz * size, size - 1)
+
+                    if lz0 > lz1 or not len(chunk):
+                        continue
+
+                    cells = self.grid(chunk).reshape(size, size, size)[
+                        lz0:lz1 + 1, ly0:ly1 + 1, lx0:lx1 + 1]
+                    lz, ly, lx = np.nonzero(cells)
+
+                    if not lx.size:
+                        continue
+
+                    values = cells[lz, ly, lx]
+                    slots = np.abs(values) - 1
+                    owners = np.frombuffer(chunk.owners, dtype=np.uint16)[slots]
+
+                    parts.append((lx + (cx * size + lx0), ly + (cy * size + ly0),
+                                  lz + (cz * size + lz0), owners.astype(np.int64), values < 0,
+                                  slots, np.full(slots.size, len(chunks))))
+                    chunks.append(chunk)
+
+        if not parts:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty, empty, np.empty(0, dtype=bool), empty, empty, chunks
+
+        return tuple(np.concatenate(column) for column in zip(*parts)) + (chunks,)
+
+    def flags(self):
+        size = self.chunk_size
+
+        for (cx, cy), chunks in self.columns.items():
+            for cz, chunk in chunks.items():
+                for slot in chunk.names:
+                    rest, lx = divmod(chunk.offsets[slot], size)
+                    lz, ly = divmod(rest, size)
+                    yield self.record(chunk, slot, cx * size + lx, cy * size + ly, cz * size + lz)
+
+    def neighbours(self, x, y, z, range):
+        return [self.record(chunk, slot, vx, vy, vz) for chunk, slot, vx, vy, vz in
+                self.scan(x - range, x + range, y - range, y + range,
+                          z - range, z + range)]
+
+    @staticmethod
+    def bounds(x, y, range):
+        # Same bounds as the former mongo query: exclusive on x and y
+        return (math.floor(x - range) + 1, math.ceil(x + range) - 1,
+                math.floor(y - range) + 1, math.ceil(y + range) - 1)
+
+    def rect(self, x_min, x_max, y_min, y_max, since=None):
+        # Voxels of the inclusive x/y rectangle at any z, as range replies carry them
+        voxels = []
+
+        for chunk, slot, vx, vy, vz in self.scan(x_min, x_max, y_min, y_max, 0, math.inf):
+            if since is not None and chunk.versions[slot] <= since:
+                continue
+            voxel = {'x': vx, 'y': vy, 'z': vz, 'owner': self.palette[chunk.owners[slot]]}
+            name = chunk.names.get(slot)
+            if name:
+                voxel['name'] = name
+            voxels.append(voxel)
+
+        return voxels
+
+    def area(self, x, y, range, since=None):
+        return self.rect(*self.bounds(x, y, range), since=since)
+
+    def rect_columns(self, x_min, x_max, y_min, y_max, since=None):
+        # rect() one chunk column at a time. A reader may yield to the loop
+        # between columns, a column is never read across a change.
+        size = self.chunk_size
+
+        for cx in range(x_min // size, x_max // size + 1):
+            for cy in range(y_min // size, y_max // size + 1):
+                if (cx, cy) not in self.columns:
+                    continue
+
+                voxels = self.rect(max(x_min, cx * size), min(x_max, cx * size + size - 1),
+                                   max(y_min, cy * size), min(y_max, cy * size + size - 1),
+                                   since)
+                if voxels:
+                    yield voxels
+
+    async def load(self, db, since=None):
+        # Everything, or only documents stamped since a bson Timestamp on top of a snapshot
+        query = {} if since is None else {'stamp': {'$gte': since}}
+
+        with MONGO_SECONDS.time(op='load_world'):
+            async for doc in db.data.find(query, projection={'_id': False, 'stamp': False}):
+                self.add(doc)
+
+        logger.info("Loaded %s voxels in %s chunk columns, world version %s",
+                    self.count, len(self.columns), self.version)
@@ -0,0 +1,184 @@
+import asyncio
+from collections import OrderedDict
+
+from pymongo.errors import BulkWriteError, ConnectionFailure, OperationFailure
+
+from turg.logger import getLogger
+from turg.metrics import MONGO_SECONDS
+
+logger = getLogger(__name__)
+
+# Server errors worth another attempt: network trouble, shutdowns and elections.
+# Anything else (a duplicate key, a failed validation) fails the same way again.
+TRANSIENT_CODES = frozenset([6, 7, 89, 91, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436])
+
+
+class WriteFailed(Exception):
+    # An operation mongo rejected or kept failing, raised to whoever submitted it
+    pass
+
+
+class BatchWriter(object):
+    # Groups write operations into one ordered bulk_write per collection.
+    # A batch is flushed when it reaches batch_size operations or
+    # flush_interval seconds after its first operation, whichever comes first.
+    # Flushes never overlap, so operations reach mongo in submission order.
+    # An operation mongo rejects fails with WriteFailed at once, the rest of
+    # the batch still succeeds. After a transient error the remaining
+    # operations go back in front of the queue and are flushed again after a
+    # backoff, up to `retries` attempts, without holding up other flushes.
+
+    def __init__(self, db, batch_size=200, flush_interval=0.02, retries=3, retry_interval=0.1):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_interval = retry_interval
+        self.pending = OrderedDict()
+        self.size = 0
+        self.timer = None
+        self.lock = asyncio.Lock()
+        self.attempts = {}
+        self.unconfirmed = set()
+        self.stats = {'operations': 0, 'batches': 0, 'errors': 0, 'retries': 0, 'failed': 0}
+
+    def submit(self, collection, operation):
+        future = asyncio.get_event_loop().create_future()
+        self.unconfirmed.add(future)
+        future.add_done_callback(self.unconfirmed.discard)
+
+        self.pending.setdefault(collection, []).append((operation, future))
+        self.size += 1
+
+        if self.size >= self.batch_size:
+            self.schedule()
+        elif self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(
+                self.flush_interval, self.schedule)
+
+        return future
+
+    def outstanding(self):
+        # Futures of every operation submitted and not written or failed yet
+        return list(self.unconfirmed)
+
+    def schedule(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if self.size:
+            asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        pending, size = self.pending, self.size
+        self.pending, self.size = OrderedDict(), 0
+
+        if not size:
+            return
+
+        async with self.lock:
+            for collection, entries in pending.items():
+                await self.write(collection, entries)
+
+            self.stats['batches'] += 1
+
+    async def write(self, collection, entries):
+        # An ordered bulk write stops at the first write error: the operations
+        # before it are done, the ones after it are sent again. Without write
+        # errors it is unknown what got through, all of it is retried.
+        attempts = self.attempts.pop(collection, 0)
+
+        while entries:
+            try:
+                with MONGO_SECONDS.time(op='bulk_write'):
+                    await self.db[collection].bulk_write([op for op, _ in entries],
+                                                         ordered=True)
+            except BulkWriteError as e:
+                write_errors = e.details.get('writeErrors')
+                if not write_errors:
+                    logger.warning("Write concern of %s operations on %s failed: %s",
+                                   len(entries), collection, e.details.get('writeConcernErrors'))
+                    break
+
+                index, code = write_errors[0]['index'], write_errors[0].get('code')
+                if index:
+                    self.resolve(entries[:index])
+                    entries = entries[index:]
+                    attempts = 0
+                failed, error = entries[:1], write_errors[0].get('errmsg')
+                if code not in TRANSIENT_CODES:
+                    self.stats['errors'] += 1
+                    entries = self.fail(collection, entries, failed, error)
+                    continue
+            except (ConnectionFailure, OperationFailure) as e:
+                failed, error = entries, e
+                if isinstance(e, OperationFailure) and e.code not in TRANSIENT_CODES:
+                    self.stats['errors'] += 1
+                    entries = self.fail(collection, entries, failed, error)
+                    continue
+            except Exception as e:
+                self.stats['errors'] += 1
+                entries = self.fail(collection, entries, entries, e)
+                continue
+            else:
+                break
+
+            attempts += 1
+            self.stats['errors'] += 1
+
+            if attempts < self.retries:
+                logger.warning("Bulk write of %s operations on %s failed, retrying: %s",
+                               len(entries), collection, error)
+                self.stats['retries'] += 1
+                self.requeue(collection, entries, attempts)
+                return
+
+            entries = self.fail(collection, entries, failed, error)
+            attempts = 0
+
+        self.resolve(entries)
+
+    def fail(self, collection, entries, failed, error):
+        # Fails the first len(failed) entries, returns the rest
+        logger.error("Bulk write of %s operations on %s failed: %s", len(failed), collection, error)
+        self.stats['failed'] += len(failed)
+        for _, future in failed:
+            if not future.done():
+                future.set_exception(WriteFailed(error))
+
+        return entries[len(failed):]
+
+    def requeue(self, collection, entries, attempts):
+        # Ahead of what was submitted meanwhile, flushed again once the backoff is over
+        self.pending[collection] = entries + self.pending.get(collection, [])
+        self.pending.move_to_end(collection, last=False)
+        self.size += len(entries)
+        self.attempts[collection] = attempts
+
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = asyncio.get_event_loop().call_later(
+            self.retry_interval * attempts, self.schedule)
+
+    def resolve(self, entries):
+        self.stats['operations'] += len(entries)
+        for _, future in entries:
+            if not future.done():
+                future.set_result(None)
+
+    async def close(self):
+        # Until everything, retries included, is written or given up
+        while True:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            await self.flush()
+            async with self.lock:
+                # A flush that was already under way
+                pass
+
+            if not self.size:
+                break
+            await asyncio.sleep(self.retry_interval)